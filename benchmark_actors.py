@@ -0,0 +1,126 @@
+"""
+    Regression benchmark of the label actors: render and pick time, and the number of actors in the renderer, against
+    the number of frames loaded so far. With the actor pool they should stay flat however long the series is.
+    The visualizer runs without its window, on a generated series whose frames hold different labels.
+
+    Usage: python benchmark_actors.py [frames] [labels per frame] [repeats]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import vtk
+from tifffile import imwrite
+import visualizer
+
+class _OffScreenWindow(vtk.vtkRenderWindow):
+    def __init__(self):
+        self.SetOffScreenRendering(1)
+        self.SetSize(400, 400)
+
+class _NoEventLoop(vtk.vtkRenderWindowInteractor):
+    def Initialize(self):
+        pass
+
+    def Start(self):
+        pass
+
+class _Value:
+    def set(self, value):
+        self.value = value
+
+class _Button:
+    def config(self, **options):
+        pass
+
+class _NoGui:
+    """ Stands in for VisualizerGui, the benchmark doesn't open any window. """
+    def __init__(self, visualizer):
+        self.slider_value = _Value()
+        self.draw_line_btn = _Button()
+
+    def run_loop(self):
+        pass
+
+    def change_mode(self, mode):
+        pass
+
+    def update_slider_position(self, value):
+        pass
+
+##############################################################################################################################
+
+def write_series(folder, frames, labels, shape = (32, 64, 64), seed = 0):
+    """ Writes frames TIF stacks with labels boxes each, every frame with other label ids than the one before. """
+    rng = np.random.default_rng(seed)
+
+    for t in range(frames):
+        img = np.zeros(shape, np.uint16)
+        for i in range(labels):
+            z, y, x = [rng.integers(0, size - 6) for size in shape]
+            img[z:z + 6, y:y + 6, x:x + 6] = t * labels + i + 1
+
+        imwrite(os.path.join(folder, f"frame_{t:04d}.tif"), img)
+
+##############################################################################################################################
+
+def open_headless(pattern):
+    """ Builds the visualizer with an off-screen render window and without the GUI and the event loop. """
+    classes = vtk.vtkRenderWindow, vtk.vtkRenderWindowInteractor, visualizer.VisualizerGui
+    vtk.vtkRenderWindow, vtk.vtkRenderWindowInteractor, visualizer.VisualizerGui = _OffScreenWindow, _NoEventLoop, _NoGui
+
+    try:
+        missing = os.path.join(os.path.dirname(pattern), "none", "*.tif")
+        return visualizer.Visualizer_3D(pattern, missing, missing, 0, -1, 1, workers = 1, cache_size = 4, prefetch = 0,
+                                        mesh_threads = 1, mesh_cache = None)
+    finally:
+        vtk.vtkRenderWindow, vtk.vtkRenderWindowInteractor, visualizer.VisualizerGui = classes
+
+##############################################################################################################################
+
+def average_time(function, repeats):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        function()
+
+    return (time.perf_counter() - start_time) / repeats
+
+def benchmark(frames = 40, labels = 50, repeats = 20):
+    """ Loads the frames one after the other and prints the render and pick times every frames / 4 frames. """
+    with tempfile.TemporaryDirectory() as folder:
+        write_series(folder, frames, labels)
+
+        # The visualizer writes its log and the hidden objects next to where it runs
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            vis = open_headless(os.path.join(folder, "*.tif"))
+            width, height = vis.renderWindow.GetSize()
+
+            print(f"{'frames':>8} {'actors':>8} {'render ms':>10} {'pick ms':>10}")
+            step = max(1, frames // 4)
+            for t in range(frames):
+                vis.t = t
+                vis.set_current_image(t)
+
+                if (t + 1) % step == 0 or t + 1 == frames:
+                    render = average_time(vis.renderWindow.Render, repeats)
+                    pick = average_time(lambda: vis.picker.Pick(width / 2, height / 2, 0, vis.renderer), repeats)
+                    actors = vis.renderer.GetActors().GetNumberOfItems()
+
+                    print(f"{t + 1:>8} {actors:>8} {render * 1000:>10.2f} {pick * 1000:>10.2f}")
+
+            vis.renderWindow.Finalize()
+        finally:
+            os.chdir(cwd)
+
+##############################################################################################################################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 4:
+        print("Usage: python benchmark_actors.py [frames] [labels per frame] [repeats]")
+        sys.exit(1)
+
+    benchmark(*[int(argument) for argument in sys.argv[1:]])
@@ -0,0 +1,107 @@
+"""
+    The surface voxels of the oversegmentation chunks of a frame in a KD-tree, to find the chunk nearest to a click
+    which missed them. The voxel of a chunk nearest to a point outside of it always has a neighbour outside of the
+    chunk, so only the surfaces are needed, which are much smaller than the volume.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from meshing import box_of_mask
+
+class ChunkIndex:
+
+    def __init__(self, overseg):
+        """
+        :param overseg: The (z, y, x) oversegmentation of the frame, 0 is background.
+        """
+        self.overseg = overseg
+        self.points = np.zeros((0, 3), np.int32)
+        self.chunks = np.zeros(0, overseg.dtype)
+        self.tree = None  # built on the first query after a change
+
+        self.add_surface(tuple(slice(0, size) for size in overseg.shape))
+
+    ##############################################################################################################################
+
+    def add_surface(self, box):
+        """ Adds the chunk voxels inside box which have a 6-neighbour with another value. """
+        # One voxel around the box is looked at, for the neighbours of its border
+        grown = tuple(slice(max(part.start - 1, 0), min(part.stop + 1, size)) for part, size in zip(box, self.overseg.shape))
+        part = np.asarray(self.overseg[grown])
+
+        surface = np.zeros(part.shape, bool)
+        for axis in range(3):
+            after = tuple(slice(1, None) if a == axis else slice(None) for a in range(3))
+            before = tuple(slice(None, -1) if a == axis else slice(None) for a in range(3))
+
+            different = part[after] != part[before]
+            surface[after] |= different
+            surface[before] |= different
+
+        surface &= part != 0
+
+        inner = tuple(slice(b.start - g.start, b.stop - g.start) for b, g in zip(box, grown))
+        positions = np.argwhere(surface[inner]).astype(np.int32) + np.array([b.start for b in box], np.int32)
+
+        self.points = np.concatenate([self.points, positions])
+        self.chunks = np.concatenate([self.chunks, self.overseg[tuple(positions.T)]])
+        self.tree = None
+
+    ##############################################################################################################################
+
+    def update(self, overseg):
+        """ Called when the oversegmentation is replaced, e.g. after chunks were split. Only the changed part is looked at again. """
+        if overseg is self.overseg:
+            return
+
+        if overseg.shape != self.overseg.shape:
+            self.__init__(overseg)
+            return
+
+        changed = box_of_mask(np.asarray(overseg) != np.asarray(self.overseg))
+        self.overseg = overseg
+
+        if changed is None:
+            return
+
+        # Voxels next to the changed ones may have become surface or stopped being surface too
+        box = tuple(slice(max(part.start - 1, 0), min(part.stop + 1, size)) for part, size in zip(changed, overseg.shape))
+
+        start = np.array([part.start for part in box])
+        stop = np.array([part.stop for part in box])
+        inside = np.all((self.points >= start) & (self.points < stop), axis = 1)
+
+        self.points = self.points[~inside]
+        self.chunks = self.chunks[~inside]
+        self.add_surface(box)
+
+    ##############################################################################################################################
+
+    def nearest(self, point, excluded = ()):
+        """
+        The chunk voxel nearest to a (z, y, x) point, leaving out the chunks in excluded. The point is expected to be
+        outside of the other chunks, a click on one of them needs no search.
+        :return: Its position and chunk id, or (None, 0) if there is none.
+        """
+        if len(self.points) == 0:
+            return None, 0
+
+        if self.tree is None:
+            self.tree = cKDTree(self.points)
+
+        excluded = np.array(list(excluded), dtype = self.chunks.dtype)
+
+        # Only the excluded chunks can be nearer, so the number of neighbours asked for grows until one is found
+        k = 8
+        while True:
+            k = min(k, len(self.points))
+            _, indices = self.tree.query(point, k = k)
+            indices = np.atleast_1d(indices)
+
+            valid = indices[~np.isin(self.chunks[indices], excluded)]
+            if len(valid) > 0:
+                return self.points[valid[0]], self.chunks[valid[0]]
+
+            if k == len(self.points):
+                return None, 0
+
+            k *= 8
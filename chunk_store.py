@@ -0,0 +1,286 @@
+"""
+    A chunked, compressed container for a whole time series: the labels, the oversegmentation and the raw data are
+    4D (t, z, y, x) arrays of one folder, in the Zarr v2 directory layout, so that other tools can open it too.
+    Every chunk is a separate zlib compressed file, so a frame is read chunk by chunk and saving an edit only
+    rewrites the chunks it touched. Only numpy is needed, like in frame_loader.
+"""
+import os
+import sys
+import glob
+import json
+import zlib
+import itertools
+import numpy as np
+from tifffile import imread
+from frame_loader import split_overseg_labels_spanning_several_real, replace_atomically
+
+LAYERS = ("labels", "overseg", "raw")
+
+##############################################################################################################################
+
+def is_chunk_store(path):
+    """ True if path is a folder created by ChunkStore. """
+    return os.path.isfile(os.path.join(path, ".zgroup"))
+
+##############################################################################################################################
+
+class ChunkedArray:
+    """ One (t, z, y, x) array of a store. Chunks span a single time point. """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, ".zarray")) as f:
+            meta = json.load(f)
+
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.level = meta["compressor"]["level"]
+
+    ##############################################################################################################################
+
+    @staticmethod
+    def create(path, shape, chunks, dtype, level = 1):
+        os.makedirs(path, exist_ok = True)
+
+        meta = {"zarr_format": 2, "shape": list(shape), "chunks": [1] + list(chunks), "dtype": np.dtype(dtype).str,
+                "compressor": {"id": "zlib", "level": level}, "fill_value": 0, "order": "C", "filters": None}
+
+        with open(os.path.join(path, ".zarray"), "w") as f:
+            json.dump(meta, f, indent = 4)
+
+        return ChunkedArray(path)
+
+    ##############################################################################################################################
+
+    def chunk_indices(self, box = None):
+        """ The (z, y, x) indices of the chunks of one time point, only those overlapping box (tuple of slices) if given. """
+        counts = [-(-size // chunk) for size, chunk in zip(self.shape[1:], self.chunks[1:])]
+
+        if box is None:
+            return itertools.product(*[range(count) for count in counts])
+
+        return itertools.product(*[range(part.start // chunk, min(-(-part.stop // chunk), count))
+                                   for part, chunk, count in zip(box, self.chunks[1:], counts)])
+
+    ##############################################################################################################################
+
+    def chunk_slices(self, index):
+        return tuple(slice(i * chunk, min((i + 1) * chunk, size)) for i, chunk, size in zip(index, self.chunks[1:], self.shape[1:]))
+
+    ##############################################################################################################################
+
+    def chunk_path(self, t, index):
+        return os.path.join(self.path, ".".join(str(i) for i in (t,) + tuple(index)))
+
+    ##############################################################################################################################
+
+    def read_chunk(self, t, index):
+        """ The part of time point t covered by the chunk, zeros if the chunk was never written. """
+        slices = self.chunk_slices(index)
+        path = self.chunk_path(t, index)
+
+        if not os.path.exists(path):
+            return np.zeros([s.stop - s.start for s in slices], dtype = self.dtype)
+
+        with open(path, "rb") as f:
+            data = np.frombuffer(zlib.decompress(f.read()), dtype = self.dtype).reshape(self.chunks[1:])
+
+        # Chunks at the border are stored in full size
+        return data[tuple(slice(0, s.stop - s.start) for s in slices)]
+
+    ##############################################################################################################################
+
+    def write_chunk(self, t, index, data):
+        path = self.chunk_path(t, index)
+
+        if not data.any():
+            # Missing chunks are read as the fill value
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        full = np.zeros(self.chunks[1:], dtype = self.dtype)
+        full[tuple(slice(0, size) for size in data.shape)] = data
+
+        # Written under another name first, so an interrupted save doesn't leave a broken chunk
+        def write(temp_path):
+            with open(temp_path, "wb") as f:
+                f.write(zlib.compress(full.tobytes(), self.level))
+
+        replace_atomically(path, write)
+
+    ##############################################################################################################################
+
+    def read_frame(self, t):
+        frame = np.zeros(self.shape[1:], dtype = self.dtype)
+
+        for index in self.chunk_indices():
+            frame[self.chunk_slices(index)] = self.read_chunk(t, index)
+
+        return frame
+
+    ##############################################################################################################################
+
+    def write_frame(self, t, frame, only_changed = True, box = None):
+        """
+        Writes the (z, y, x) array frame as time point t.
+        :param only_changed: Compare with the stored chunks and only rewrite the ones which differ.
+        :param box: Box (tuple of slices) outside of which frame is known to be the same as the stored one. Only the
+            chunks overlapping it are written, without comparing them. None looks at every chunk.
+        :return: The number of chunks written.
+        """
+        if frame.shape != self.shape[1:]:
+            raise ValueError("frame of shape " + str(frame.shape) + " doesn't fit a store of shape " + str(self.shape))
+
+        if frame.size > 0 and frame.max() > np.iinfo(self.dtype).max:
+            raise ValueError("labels up to " + str(frame.max()) + " don't fit the " + str(self.dtype) + " store")
+
+        written = 0
+        for index in self.chunk_indices(box):
+            data = frame[self.chunk_slices(index)]
+
+            if only_changed and box is None and np.array_equal(data, self.read_chunk(t, index)):
+                continue
+
+            self.write_chunk(t, index, data.astype(self.dtype))
+            written += 1
+
+        return written
+
+##############################################################################################################################
+
+class ChunkStore:
+    """ The folder with the labels, overseg and raw arrays of a time series. """
+
+    def __init__(self, path):
+        self.path = path
+        self.layers = {}
+
+        for name in LAYERS:
+            if os.path.isfile(os.path.join(path, name, ".zarray")):
+                self.layers[name] = ChunkedArray(os.path.join(path, name))
+
+        self.shape = self.layers["labels"].shape
+
+    ##############################################################################################################################
+
+    def __len__(self):
+        return self.shape[0]
+
+    ##############################################################################################################################
+
+    def has(self, name):
+        return name in self.layers
+
+    ##############################################################################################################################
+
+    @staticmethod
+    def create(path, shape, dtypes, chunks = (64, 64, 64), level = 1):
+        """
+        Creates an empty store.
+        :param shape: The (t, z, y, x) shape of the time series.
+        :param dtypes: Dictionary from layer name to numpy type, for the layers to create.
+        """
+        os.makedirs(path, exist_ok = True)
+
+        with open(os.path.join(path, ".zgroup"), "w") as f:
+            json.dump({"zarr_format": 2}, f)
+
+        for name, dtype in dtypes.items():
+            ChunkedArray.create(os.path.join(path, name), shape, chunks, dtype, level)
+
+        return ChunkStore(path)
+
+    ##############################################################################################################################
+
+    def read(self, name, t):
+        return self.layers[name].read_frame(t)
+
+    ##############################################################################################################################
+
+    def write(self, name, t, frame, box = None):
+        return self.layers[name].write_frame(t, frame, box = box)
+
+##############################################################################################################################
+
+def load_store_frame(path, t, raw = None):
+    """
+    Reads time point t of a store and preprocesses it like load_frame does for TIF files, so the result can be used
+    the same way. Runs inside a worker process.
+    :param raw: "raw" if the raw layer is loaded too, else None.
+    """
+    store = ChunkStore(path)
+
+    real_img = store.read("labels", t)
+
+    current_labels = list(np.unique(real_img))
+    if 0 in current_labels:
+        current_labels.remove(0)
+
+    if store.has("overseg"):
+        overseg = store.read("overseg", t)
+    else:
+        overseg = np.copy(real_img)
+
+    overseg = split_overseg_labels_spanning_several_real(real_img, overseg)
+
+    return {"labels": real_img, "unique": current_labels, "overseg": overseg, "raw": load_store_raw(path, t, raw)}
+
+##############################################################################################################################
+
+def load_store_labels(path, t, raw = None):
+    return ChunkStore(path).read("labels", t)
+
+##############################################################################################################################
+
+def load_store_raw(path, t, raw = None):
+    if raw is None:
+        return None
+
+    return ChunkStore(path).read(raw, t)
+
+##############################################################################################################################
+
+def convert_tiff_folders(image_folder, overseg_folder, raw_folder, path, chunks = (64, 64, 64)):
+    """
+    Creates a store from folders of TIF stacks, one file per time point. Files are matched by their sorted order.
+    The overseg and raw folders can be None.
+    """
+    layers = {"labels": sorted(glob.glob(os.path.join(image_folder, "*.tif")))}
+
+    if overseg_folder is not None:
+        layers["overseg"] = sorted(glob.glob(os.path.join(overseg_folder, "*.tif")))
+    if raw_folder is not None:
+        layers["raw"] = sorted(glob.glob(os.path.join(raw_folder, "*.tif")))
+
+    layers = {name: files for name, files in layers.items() if len(files) > 0}
+
+    first = {name: imread(files[0]) for name, files in layers.items()}
+    shape = (len(layers["labels"]),) + first["labels"].shape
+
+    # Labels and chunk ids may grow during curation, so they get room for it. The raw data keeps its type.
+    dtypes = {name: np.uint32 for name in layers.keys()}
+    if "raw" in layers:
+        dtypes["raw"] = first["raw"].dtype
+
+    store = ChunkStore.create(path, shape, dtypes, chunks)
+
+    for name, files in layers.items():
+        for t, file in enumerate(files[:shape[0]]):
+            store.write(name, t, imread(file))
+            print("Converted " + file)
+
+    return store
+
+##############################################################################################################################
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 5:
+        print("Usage: python chunk_store.py <segmentation folder> <overseg folder or -> <raw folder or -> <output folder>")
+        sys.exit(1)
+
+    folders = [None if folder == "-" else folder for folder in sys.argv[1:4]]
+    convert_tiff_folders(folders[0], folders[1], folders[2], sys.argv[4])
@@ -1,7 +1,6 @@
 import vtk
 import numpy as np
-from matplotlib.path import Path
-from scipy.spatial import cKDTree
+from lasso import Lasso, voxel_projection
 
 class CustomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
 
@@ -18,10 +17,6 @@ class CustomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
         self.startPos = None  # To store the start position of the drag
         self.endPos = None  # To store the end position of the drag
 
-        self.cellLocator = vtk.vtkCellLocator()
-        self.cellLocator.SetDataSet(self.visualizer_3d.imageData)
-        self.cellLocator.BuildLocator()
-
         self.path = []  # To store the path of the drag
         self.polylineActor = vtk.vtkActor()
         self.polylineActor.GetProperty().SetColor(1.0, 1.0, 0.0)
@@ -269,8 +264,7 @@ class CustomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
             return
 
         if len(self.visualizer_3d.selected_labels) == 0:
-            self.visualizer_3d.backup = vtk.vtkImageData()
-            self.visualizer_3d.backup.DeepCopy(self.visualizer_3d.imageDataObjects[self.visualizer_3d.t])
+            self.visualizer_3d.backup = self.visualizer_3d.get_numpy_array(self.visualizer_3d.t).copy(order = 'F')
 
         # Ensure there is at least one point to draw
         if len(self.path) < 2:
@@ -284,176 +278,38 @@ class CustomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
         else:
             source_object = self.find_centroid_object_id(self.path)
 
-        axisSpacing = self.visualizer_3d.imageData.GetSpacing()
-        picker = self.visualizer_3d.picker
-
-        # Use the collected inside points from the path instead of a rectangle grid
-        inside_points = self.collect_inside_points()
-        inside_points = [self.screenToWorld(currentPos[0], currentPos[1]) for currentPos in inside_points]
-        
-        intersectedPoints = []
-        vtk_array = self.visualizer_3d.imageDataObjects[self.visualizer_3d.t].GetPointData().GetScalars()
-
-        for pickedPosition in inside_points:
-                     
-            rayStart = self.visualizer_3d.renderer.GetActiveCamera().GetPosition()
-            rayEnd = pickedPosition
-
-
-            rayDirection = np.subtract(rayEnd, rayStart)
-            rayDirectionNormalized = rayDirection / np.linalg.norm(rayDirection)
-            
-            # Perform ray cast to find cells intersected by the ray
-            cellIds = vtk.vtkIdList()
-            extensionFactor = 1000
-            rayStartExtended = pickedPosition - (rayDirectionNormalized * extensionFactor)
-            rayEndExtended = pickedPosition + (rayDirectionNormalized * extensionFactor)
-
-            """
-            intersectedPoints = self.find_pixels_along_line(rayStartExtended, rayEndExtended)
-            for i, point in enumerate(intersectedPoints):
-                point = [point[d] / axisSpacing[d] for d in range(3)]
-                intersectedPoints[i] = point
-
-
-            """
-            self.cellLocator.FindCellsAlongLine(rayStartExtended, rayEndExtended, 0.01, cellIds)
-            
-            # Processing the intersected cells
-            numCells = cellIds.GetNumberOfIds()
-            for i in range(numCells):
-                cellId = cellIds.GetId(i)
-                cell = self.visualizer_3d.imageDataObjects[self.visualizer_3d.t].GetCell(cellId)
-                points = cell.GetPoints()
-                for j in range(points.GetNumberOfPoints()):
-                    point = points.GetPoint(j)
-                    normalizedPoint = [point[d] / axisSpacing[d] for d in range(3)]
-                    intersectedPoints.append(normalizedPoint)
-
-                
-
-        points_to_update = []
-
-        
-        for imageCoordinates in intersectedPoints:
-            i, j, k = imageCoordinates
-            pointId = self.visualizer_3d.imageData.ComputePointId((int(i), int(j), int(k)))
-            points_to_update.append(pointId)
-
-        points_to_update = np.unique(points_to_update)
-        points_updated = []
+        if source_object is None:
+            return
 
-        for id in points_to_update:
+        selection = self.visualizer_3d.selection_label()
+        t = self.visualizer_3d.t
 
-            if id < 0 or id >= vtk_array.GetNumberOfTuples():
-                continue
+        # The voxels of the source object whose centers are projected inside the lasso, at any depth
+        image_data = self.visualizer_3d.imageDataObjects[t]
+        projection, parallel = voxel_projection(self.visualizer_3d.renderer, image_data)
+        points_to_update = Lasso(self.path).voxels(projection, parallel, image_data.GetDimensions(),
+                                                   self.visualizer_3d.voxels_of_label(t, source_object))
 
-            real_id = vtk_array.GetTuple1(id)
-            if real_id == source_object:
-                vtk_array.SetTuple1(id, 255)
-                self.visualizer_3d.selected_labels.append(real_id)
-                points_updated.append(id)
+        # Only the voxels of the source object are selected
+        points_updated, _ = self.visualizer_3d.write_labels(t, points_to_update, selection,
+                                                            lambda values: values == source_object)
 
+        if len(points_updated) > 0:
+            self.visualizer_3d.selected_labels.append(source_object)
         self.visualizer_3d.selected_labels = list(np.unique(self.visualizer_3d.selected_labels))
 
         #self.visualizer_3d.selected_labels = list(np.unique(self.visualizer_3d.selected_labels))
         self.visualizer_3d.selected_voxels += list(points_updated)
 
+        print (self.visualizer_3d.selected_labels + [selection])
 
-        # Update imageData with new colors
-        self.visualizer_3d.imageDataObjects[self.visualizer_3d.t].Modified()
-
-        print (self.visualizer_3d.selected_labels + [255])
-
-        self.visualizer_3d.init_surfaces(self.visualizer_3d.selected_labels + [255], self.visualizer_3d.t)
+        self.visualizer_3d.init_surfaces(self.visualizer_3d.selected_labels + [selection], self.visualizer_3d.t)
         self.visualizer_3d.set_current_image(self.visualizer_3d.t)
 
         #self.visualizer_3d.renderer.GetRenderWindow().Render()
 
     ##############################################################################################################################
 
-    def collect_inside_points(self):
-        print ("collect_inside_points")
-        """
-        Collect all 2D screen coordinates within a given path.
-        
-        Args:
-        - path_points: A list of 2D tuples or numpy arrays representing the screen coordinates (x, y).
-        
-        Returns:
-        - A list of 2D screen coordinates within the closed path.
-        """
-
-        path_points = self.path
-        
-        # Ensure the path is closed by connecting the last point to the first if they are not already connected.
-        if path_points[0] != path_points[-1]:
-            path_points.append(path_points[0])
-        
-        # Create a Path object (using matplotlib for simplicity, assuming straightforward paths without complicated self-intersections)
-        path_obj = Path(path_points)
-        
-        # Get bounding box of the path to minimize the search area for interior points
-        bbox = path_obj.get_extents()
-
-        # Calculate the view angle and depth of field based on camera settings
-        depthOfField = self.visualizer_3d.renderer.GetActiveCamera().GetDistance()
-        resolution = 2 * (1 + int(800 / depthOfField)) #TODO - does this depend on the dimension of the input?
-        
-        # Generate a grid of points within the bounding box
-        x, y = np.meshgrid(
-            np.arange(bbox.xmin, bbox.xmax + 1, resolution), 
-            np.arange(bbox.ymin, bbox.ymax + 1, resolution)
-        )
-        grid_points = np.vstack((x.flatten(), y.flatten())).T
-        
-        # Filter points to find which are inside the path
-        inside_points = [point for point in grid_points if path_obj.contains_point(point)]
-        
-        # Filter points near the edge
-        exclusion_distance = 1.0  # The exact value will need adjustment based on your coordinate system and requirements
-        inside_points = self.filter_near_edge_points(inside_points, path_obj, exclusion_distance)
-        
-        return inside_points
-
-    ##############################################################################################################################
-
-    def filter_near_edge_points(self, inside_points, path_obj, exclusion_distance=1.0):
-        # Convert the path object's vertices to a list of points
-        path_points = [path_obj.vertices[i] for i in range(len(path_obj.vertices))]
-
-        filtered_points = []
-        for point in inside_points:
-            # Calculate distance of the point from the path edge
-            distance = self.calculate_distance_from_path_edge(point, path_points)
-            if distance > exclusion_distance:
-                filtered_points.append(point)
-                
-        return filtered_points
-
-    ##############################################################################################################################
-
-    def calculate_distance_from_path_edge(self, point, path_points):
-        """
-        Calculates the minimum distance from a point to the closest edge point of the path.
-        
-        Args:
-        - point: The point for which we want to calculate the distance to the path.
-        - path_points: A list of points that define the edges of the path.
-        
-        Returns:
-        - The minimum distance from the point to the closest point on the path.
-        """
-        # Create a cKDTree object for efficient nearest neighbor searches
-        tree = cKDTree(path_points)
-
-        # Query the tree for the nearest neighbor to the 'point'
-        distance, _ = tree.query(point)
-
-        return distance
-
-    ##############################################################################################################################
-
     def find_centroid_object_id(self, inside_points):
         """
         Finds the real_id of the object located at the geometric center
@@ -494,11 +350,11 @@ class CustomInteractorStyle(vtk.vtkInteractorStyleTrackballCamera):
             real_id =  vtk_array.GetTuple1(pointId)
             print ("real id = ", real_id)
 
-            if real_id == 0 or self.visualizer_3d.visible[real_id] == False:
-                return 255
+            if real_id == 0 or not self.visualizer_3d.is_label_visible(real_id):
+                return self.visualizer_3d.selection_label()
             else:
                 return real_id
         else:
-            return 255
+            return self.visualizer_3d.selection_label()
 
     
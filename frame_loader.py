@@ -0,0 +1,279 @@
+"""
+    Decodes and preprocesses segmentation, oversegmentation and raw TIF stacks in worker processes.
+    Only numpy and tifffile are used here. The spawned workers also import the main script of the program again,
+    so it has to keep VTK and Tkinter behind its __main__ guard (see pyfix3d.py), else every worker initializes them.
+"""
+import os
+import stat
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tifffile
+from tifffile import imread, imwrite
+
+def split_overseg_labels_spanning_several_real(img, overseg, label = None):
+    """
+    Makes sure no oversegmentation chunk spans more than one real label, by giving every
+    extra real label inside a chunk a new chunk id.
+    :param img: The segmentation (real labels) of the frame.
+    :param overseg: The oversegmentation of the same frame.
+    :param label: If given, only this chunk is checked.
+    :return: The corrected oversegmentation.
+    """
+    unique_labels = np.unique(overseg)
+    # Ensure we don't process the background (0 label)
+    mask = overseg != 0
+    max_label = unique_labels[-1]
+
+    img_flattened = img[mask]
+    overseg_flattened = overseg[mask]
+
+    # Only copied when a chunk has to be split, so a memory-mapped overseg stays mapped otherwise
+    new_overseg = None
+
+    to_split = unique_labels[1:]
+    if label is not None:
+        to_split = [label]
+
+    for obj in to_split:
+        mask_obj = overseg_flattened == obj
+        img_segment = img_flattened[mask_obj]
+
+        # Skipping background pixels if present
+        img_segment = img_segment[img_segment > 0]
+
+        if len(img_segment) > 0:
+            unique_components = list(np.unique(img_segment))
+            if 0 in unique_components:
+                unique_components.remove(0)
+
+            if len(unique_components) == 1:
+                # Segment is homogeneous enough; skip splitting
+                continue
+            else:
+                # If not homogeneous, proceed with individual adjustments
+                mode_label = unique_components[0]
+                max_label += 1
+                # Ensure other objects in the segment get unique labels if they do not exceed the threshold
+                for real_obj in np.unique(img_segment):
+
+                    if real_obj != mode_label:
+                        max_label += 1
+                        specific_mask = (overseg == obj) & (img == real_obj)
+                        if new_overseg is None:
+                            new_overseg = np.array(overseg)
+                        new_overseg[specific_mask] = max_label
+
+    if new_overseg is None:
+        return overseg
+
+    return new_overseg
+
+##############################################################################################################################
+
+def label_dtype(max_label):
+    """ The smallest unsigned integer type which can hold every label up to max_label. """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return dtype
+
+    return np.uint64
+
+##############################################################################################################################
+
+def read_tiff(path, mode = None):
+    """
+    Reads a TIF stack. If mode is given and the image data in the file is uncompressed and contiguous,
+    the file is memory-mapped instead of read, so that untouched data only costs page cache.
+    :param path: The TIF file.
+    :param mode: None to always read, 'r' for a read-only mapping, 'c' for a copy-on-write mapping.
+    """
+    if mode is not None:
+        try:
+            return tifffile.memmap(path, mode = mode)
+        except ValueError:
+            pass  # compressed or not contiguous
+
+    return imread(path)
+
+##############################################################################################################################
+
+# Read once, as setting it to read it isn't thread safe and files are saved by several threads
+_umask = os.umask(0)
+os.umask(_umask)
+
+def replace_atomically(path, write):
+    """
+    Calls write(temp_path) for a temporary file next to path, then renames it to path, so that readers never see
+    a half written file. The temporary file is removed if write fails.
+    """
+    folder, name = os.path.split(path)
+    handle, temp_path = tempfile.mkstemp(prefix = "." + name + ".", suffix = ".tmp", dir = folder or ".")
+    os.close(handle)
+
+    try:
+        write(temp_path)
+
+        # mkstemp makes the file readable by its owner only. It gets the mode of the file it replaces instead, or the
+        # mode a new file would get.
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_umask
+        os.chmod(temp_path, mode)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return path
+
+##############################################################################################################################
+
+def write_tiff(path, array, compression = None):
+    """
+    Writes a TIF stack under a temporary name and renames it into place, so an interrupted save never
+    leaves a truncated file behind.
+    :param compression: None, 'zlib' or 'zstd' (the latter needs imagecodecs).
+    """
+    return replace_atomically(path, lambda temp_path: imwrite(temp_path, array, compression = compression))
+
+##############################################################################################################################
+
+def copy_tiff(source, path):
+    """ Copies an unchanged TIF stack the same way write_tiff writes one. Nothing is done if both are the same file. """
+    if os.path.exists(path) and os.path.samefile(source, path):
+        return path
+
+    return replace_atomically(path, lambda temp_path: shutil.copyfile(source, temp_path))
+
+##############################################################################################################################
+
+def load_frame(image_file, overseg_file, raw_file, memmap = True):
+    """
+    Reads one time point and does the per-frame preprocessing which doesn't depend on other frames.
+    Runs inside a worker process, so everything it returns must be picklable.
+    :param image_file: Path to the segmentation TIF.
+    :param overseg_file: Path to the matching oversegmentation TIF, or None to use the segmentation itself.
+    :param raw_file: Path to the raw intensity TIF, or None.
+    :param memmap: Memory-map the files when possible. Labels and overseg are mapped copy-on-write, raw read-only.
+        The visualizer copies the labels into Fortran order anyway, for them this only saves the decode buffer.
+    :return: A dictionary with the segmentation, its labels (without 0), the oversegmentation and the raw stack.
+    """
+    real_img = read_tiff(image_file, "c" if memmap else None)
+
+    current_labels = list(np.unique(real_img))
+    if 0 in current_labels:
+        current_labels.remove(0)
+
+    if overseg_file is not None:
+        overseg = read_tiff(overseg_file, "c" if memmap else None)
+    elif isinstance(real_img, np.memmap):
+        overseg = read_tiff(image_file, "c")  # a second private mapping instead of a copy
+    else:
+        overseg = np.copy(real_img)
+
+    overseg = split_overseg_labels_spanning_several_real(real_img, overseg)
+
+    raw_img = load_raw(image_file, overseg_file, raw_file, memmap)
+
+    return {"labels": real_img, "unique": current_labels, "overseg": overseg, "raw": raw_img}
+
+##############################################################################################################################
+
+def load_labels(image_file, overseg_file, raw_file, memmap = True):
+    """ Reads only the segmentation of a time point, with the same arguments as load_frame. """
+    return read_tiff(image_file, "r" if memmap else None)
+
+##############################################################################################################################
+
+def load_raw(image_file, overseg_file, raw_file, memmap = True):
+    """ Reads only the raw stack of a time point, with the same arguments as load_frame. """
+    if raw_file is None:
+        return None
+
+    return read_tiff(raw_file, "r" if memmap else None)
+
+##############################################################################################################################
+
+class _MappedFile:
+    """ Stands in for a memory-mapped array sent back from a worker, which would otherwise be pickled as a copy. """
+
+    def __init__(self, array):
+        self.filename = array.filename
+        self.mode = array.mode
+
+##############################################################################################################################
+
+def _load_frame_job(load, job):
+    frame = load(*job)
+
+    for key in ("labels", "overseg", "raw"):
+        if isinstance(frame[key], np.memmap) and frame[key].filename is not None:
+            frame[key] = _MappedFile(frame[key])
+
+    return frame
+
+##############################################################################################################################
+
+def _map_again(frame):
+    for key in ("labels", "overseg", "raw"):
+        if isinstance(frame[key], _MappedFile):
+            frame[key] = tifffile.memmap(frame[key].filename, mode = frame[key].mode)
+
+    return frame
+
+##############################################################################################################################
+
+class FrameLoader:
+    """
+    Loads a list of frames with a pool of worker processes and hands the results back in the order of the jobs.
+    With workers <= 1 everything is done in the calling process. The pool is kept for the next load_all until close,
+    use it in a with statement.
+    """
+
+    def __init__(self, workers = None, load = load_frame):
+        """
+        :param load: Module-level function called with the arguments of a job, returning what load_frame returns.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = max(1, int(workers))
+        self.load = load
+        self.executor = None  # started by the first load_all with more than one job, kept until close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Stops the worker processes. """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    ##############################################################################################################################
+
+    def load_all(self, jobs):
+        """
+        Generator over the loaded frames, in the same order as jobs.
+        :param jobs: List of argument tuples for the load function.
+        """
+        if self.workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                yield self.load(*job)
+            return
+
+        # Starting spawned workers takes seconds, so they are reused by the next calls until close
+        if self.executor is None:
+            # spawn behaves the same on every platform and doesn't duplicate the VTK/Tk state of the parent
+            context = multiprocessing.get_context("spawn")
+            self.executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = context)
+
+        for result in self.executor.map(_load_frame_job, [self.load] * len(jobs), jobs):
+            yield _map_again(result)
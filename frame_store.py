@@ -0,0 +1,499 @@
+"""
+    Keeps a bounded number of decoded time points in memory and loads the others on demand.
+    Frames which were edited are written to a scratch folder when they are evicted, instead of being dropped.
+    With a memory budget, the memory held by the frames is counted as well, and what can be rebuilt is freed first.
+"""
+import os
+import mmap
+import atexit
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter
+import numpy as np
+from frame_loader import FrameLoader, load_frame, load_raw, load_labels
+
+class Frame:
+    """ Everything the visualizer keeps in memory for one time point. """
+
+    def __init__(self, t):
+        self.t = t
+        self.image_data = None  # vtkImageData with the segmentation labels
+        self.labels = None      # (z, y, x) numpy array sharing its buffer with the scalars of image_data
+        self.chunk_index = None  # ChunkIndex of overseg, built the first time a click misses the chunks
+        self.label_voxels = None  # VoxelIndex of labels, built the first time the voxels of a label are needed
+        self.chunk_voxels = None  # VoxelIndex of overseg
+        self.highlights = {}    # chunk id -> vtkActor highlighting its surface when it is selected
+        self.overseg = None     # numpy array with the oversegmentation
+        self.raw = None         # vtkImageData with the raw intensities, if available
+        self.raw_array = None   # numpy array sharing its buffer with the scalars of raw
+        self.reload_raw = None  # called with the frame to read raw again after it was freed
+        self.meshes = None      # label -> vtkPolyData, built the first time the frame is shown
+        self.lods = {}          # label -> coarser vtkPolyData of its mesh, built in the background
+        self.blocks = {}        # label -> block index -> vtkPolyData, for labels whose surface was rebuilt by blocks
+        self.combined = {}      # level of detail -> (labels, their surfaces, their translations, vtkPolyData of all) for the 'lut' render mode
+        self.edit_box = None    # box around the voxels written since the surfaces were last rebuilt
+        self.save_box = None    # box around the voxels written since the frame was last saved
+        self.extents = None     # label -> bounding box (tuple of slices), never smaller than the label
+        self.label_counts = None  # LabelCounts, the number of voxels of every label
+        self.dirty = False      # edited since it was read from the source files
+
+    @property
+    def overseg(self):
+        return self._overseg
+
+    @overseg.setter
+    def overseg(self, overseg):
+        # Chunk ids may have been given to other voxels, e.g. when chunks were split
+        if overseg is not getattr(self, "_overseg", None):
+            self.highlights = {}
+
+        self._overseg = overseg
+        self.overseg_extents = None  # chunk id -> bounding box, computed again when needed
+
+        if overseg is None:
+            self.chunk_index = None
+            self.chunk_voxels = None
+
+        if self.chunk_index is not None:
+            self.chunk_index.update(overseg)
+        if self.chunk_voxels is not None:
+            self.chunk_voxels.update(overseg)
+
+    @property
+    def raw(self):
+        if self._raw is None and self.reload_raw is not None:
+            reload, self.reload_raw = self.reload_raw, None
+            reload(self)
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        self._raw = raw
+
+    def drop_meshes(self):
+        """ Frees the surfaces, they are built again (or read from the mesh cache) when the frame is shown. """
+        self.meshes = None
+        self.lods = {}
+        self.blocks = {}
+        self.combined = {}
+        self.edit_box = None
+        self.highlights = {}
+
+    def drop_indexes(self):
+        """ Frees the voxel indexes, they are built again when they are used. """
+        self.label_voxels = None
+        self.chunk_voxels = None
+
+    def drop_raw(self, reload):
+        """ Frees the raw data until it is used again, then reload(frame) reads it. """
+        self._raw = None
+        self.raw_array = None
+        self.reload_raw = reload
+
+    def memory(self):
+        """ Bytes held by the frame, by kind. Memory-mapped arrays only cost page cache, so they aren't counted. """
+        meshes = {}
+        if self.meshes is not None:
+            meshes.update((id(mesh), mesh) for mesh in self.meshes.values())
+        meshes.update((id(mesh), mesh) for levels in self.lods.values() for mesh in levels)
+        meshes.update((id(mesh), mesh) for blocks in self.blocks.values() for mesh in blocks.values())
+        meshes.update((id(combined), combined) for _, _, _, combined in self.combined.values())
+        meshes.update((id(actor), actor.GetMapper().GetInput()) for actor in self.highlights.values())
+
+        return {"labels": array_bytes(self.labels),
+                "overseg": array_bytes(self._overseg),
+                "raw": array_bytes(self.raw_array),
+                "index": sum(index.nbytes() for index in (self.label_voxels, self.chunk_voxels) if index is not None),
+                "meshes": 1024 * sum(mesh.GetActualMemorySize() for mesh in meshes.values())}  # VTK counts in KiB
+
+##############################################################################################################################
+
+def array_bytes(array):
+    """ The memory of a numpy array, 0 if its data is a memory-mapped file. """
+    if array is None:
+        return 0
+
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return 0
+        base = getattr(base, "base", None)
+
+    return array.nbytes
+##############################################################################################################################
+
+class FrameView:
+    """
+    List-like access to one attribute of all frames, so that e.g. imageDataObjects[t] keeps working.
+    Frames are loaded on first access.
+    """
+
+    def __init__(self, store, attribute, available = True):
+        self.store = store
+        self.attribute = attribute
+        self.available = available
+
+    def __len__(self):
+        if not self.available:
+            return 0
+        return len(self.store)
+
+    def __getitem__(self, t):
+        return getattr(self.store.get(t), self.attribute)
+
+    def __setitem__(self, t, value):
+        setattr(self.store.get(t), self.attribute, value)
+        self.store.mark_dirty(t)
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+##############################################################################################################################
+
+class FrameStore:
+
+    def __init__(self, jobs, build_frame, get_label_array, cache_size = 8, workers = None, load = load_frame, load_raw = load_raw,
+                 build_raw = None, memory_budget = None, load_labels = load_labels):
+        """
+        :param jobs: One tuple of arguments for load per time point. The third one is the raw source, or None.
+        :param build_frame: Called as build_frame(frame, decoded) to fill a new Frame from the decoded arrays.
+        :param get_label_array: Returns the current segmentation of a Frame as a (z, y, x) numpy array, for spilling.
+        :param cache_size: Number of frames kept in memory, besides the pinned (shown) one.
+        :param workers: Number of worker processes used when several frames are loaded at once.
+        :param load: Reads a time point, see load_frame (TIF files) and chunk_store.load_store_frame.
+        :param load_raw: Reads only the raw data of a time point, with the same arguments as load.
+        :param build_raw: Called as build_raw(frame, raw) to give a Frame its raw data again, after it was freed.
+        :param memory_budget: Bytes the frames in memory may hold, None for no limit besides cache_size. Over it,
+            memory is freed in this order: the voxel indexes and surfaces of the frames farthest from the shown one, their raw data
+            (if build_raw is given), then whole frames which weren't edited. The shown frame is never touched.
+        :param load_labels: Reads only the segmentation of a time point, with the same arguments as load.
+        """
+        self.jobs = jobs
+        self.build_frame = build_frame
+        self.get_label_array = get_label_array
+        self.cache_size = max(1, int(cache_size))
+        self.workers = workers
+        self.load = load
+        self.loader = FrameLoader(workers, load)  # its worker processes are started once and kept until close
+        self.load_raw = load_raw
+        self.load_labels = load_labels
+        self.build_raw = build_raw
+        self.memory_budget = memory_budget
+        self.freed = Counter()  # kind -> number of times it was freed to stay within the budget
+
+        self.cache = OrderedDict()  # t -> Frame, least recently used first
+        self.spilled = {}  # t -> number of times the frame was spilled
+        self.unsaved = set()  # time points edited since the last save
+        self.scratch_folder = None
+
+        self.pinned = None  # the shown time point, never evicted
+        self.lock = threading.RLock()  # frames are also loaded by the prefetcher's thread
+
+    ##############################################################################################################################
+
+    def __len__(self):
+        return len(self.jobs)
+
+    ##############################################################################################################################
+
+    def has_raw(self):
+        return len(self.jobs) > 0 and self.jobs[0][2] is not None
+
+    ##############################################################################################################################
+
+    def is_loaded(self, t):
+        return t in self.cache
+
+    ##############################################################################################################################
+
+    def get(self, t):
+        """ Returns the Frame for time point t, loading it if needed. """
+        if t < 0 or t >= len(self.jobs):
+            raise IndexError("frame index out of range: " + str(t))
+
+        with self.lock:
+            if t in self.cache:
+                self.cache.move_to_end(t)
+                return self.cache[t]
+
+            return self.add(t, self.decode(t))
+
+    ##############################################################################################################################
+
+    def preload(self, t):
+        """ Loads frame t if needed, without holding the lock while it is decoded. Used from other threads. """
+        if self.is_loaded(t):
+            return
+
+        decoded = self.decode(t)
+
+        with self.lock:
+            if t not in self.cache:
+                self.add(t, decoded)
+
+    ##############################################################################################################################
+
+    def iterate(self, time_points):
+        """
+        Yields the time points one by one, after making sure the frame is in memory.
+        Frames which have to be read from the source files are decoded in parallel, cache_size at a time.
+        """
+        time_points = list(time_points)
+
+        for begin in range(0, len(time_points), self.cache_size):
+            batch = time_points[begin:begin + self.cache_size]
+            to_decode = [t for t in batch if t not in self.cache and t not in self.spilled]
+
+            for t, decoded in zip(to_decode, self.loader.load_all([self.jobs[t] for t in to_decode])):
+                with self.lock:
+                    if t not in self.cache:
+                        self.add(t, decoded)
+
+            for t in batch:
+                self.get(t)
+                yield t
+
+    ##############################################################################################################################
+
+    def close(self):
+        """ Stops the worker processes of the loader. """
+        self.loader.close()
+
+    ##############################################################################################################################
+
+    def labels_of(self, t):
+        """
+        The labels (without 0) time point t holds, without loading it into the cache: those of the frame if it is in
+        memory or was spilled, else those of its source.
+        """
+        # Not under the lock, this is called from other threads while a frame is being added
+        frame = self.cache.get(t)
+        if frame is not None and frame.label_counts is not None:
+            return frame.label_counts.present()
+
+        if t in self.spilled:
+            labels = np.load(self.scratch_path(t, "labels"), mmap_mode = "r")
+        else:
+            labels = self.load_labels(*self.jobs[t])
+
+        values = np.unique(labels)
+        return values[values != 0]
+
+    ##############################################################################################################################
+
+    def all_labels(self):
+        """ The labels of every time point, loaded or not, read in parallel. """
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            return set(int(label) for labels in executor.map(self.labels_of, range(len(self.jobs))) for label in labels)
+
+    ##############################################################################################################################
+
+    def mark_dirty(self, t):
+        with self.lock:
+            self.get(t).dirty = True
+            self.unsaved.add(t)
+
+    ##############################################################################################################################
+
+    def mark_saved(self, time_points):
+        self.unsaved.difference_update(time_points)
+
+        with self.lock:
+            for t in time_points:
+                if t in self.cache:
+                    self.cache[t].save_box = None
+
+    ##############################################################################################################################
+
+    def is_modified(self, t):
+        """ True if frame t differs from its source file, i.e. it was edited (or relabelled when loaded). """
+        with self.lock:
+            if t in self.spilled:
+                return True
+
+            return t in self.cache and self.cache[t].dirty
+
+    ##############################################################################################################################
+
+    def decode(self, t):
+
+        if t in self.spilled:
+            return self.read_spilled(t)
+
+        return self.load(*self.jobs[t])
+
+    ##############################################################################################################################
+
+    def add(self, t, decoded):
+
+        frame = Frame(t)
+        self.build_frame(frame, decoded)
+
+        if t in self.spilled:
+            frame.dirty = True
+            frame.save_box = tuple(slice(0, size) for size in frame.labels.shape)  # edited before, but where isn't known
+        elif frame.dirty:
+            self.unsaved.add(t)  # changed while it was built
+
+        self.cache[t] = frame
+        self.cache.move_to_end(t)
+        self.evict(keep = t)
+        self.enforce_budget(keep = t)
+
+        return frame
+
+    ##############################################################################################################################
+
+    def evict(self, keep = None):
+        """
+        Removes the least recently used frames until at most cache_size are left besides the pinned one, which
+        isn't counted. The frame keep (the one just added, which the caller is about to use) is never removed.
+        """
+        while len([t for t in self.cache if t != self.pinned]) > self.cache_size:
+            candidates = [t for t in self.cache if t != self.pinned and t != keep]
+            if len(candidates) == 0:
+                return
+
+            frame = self.cache.pop(candidates[0])
+
+            if frame.dirty:
+                self.spill(frame)
+
+    ##############################################################################################################################
+
+    def memory(self):
+        """ The bytes held by the frames in memory, by kind. """
+        with self.lock:
+            total = Counter()
+            for frame in self.cache.values():
+                total.update(frame.memory())
+
+        return total
+
+    ##############################################################################################################################
+
+    def enforce_budget(self, keep = None):
+        """
+        Frees memory in the order given in __init__ until the frames fit into memory_budget. The frame keep (the one
+        just added, which the caller is about to use) is never removed, only its indexes, surfaces and raw data.
+        """
+        if self.memory_budget is None:
+            return
+
+        with self.lock:
+            usage = {t: frame.memory() for t, frame in self.cache.items()}
+            total = sum(sum(memory.values()) for memory in usage.values())
+
+            if total <= self.memory_budget:
+                return
+
+            # Farthest from the shown time point first, else least recently used first
+            candidates = [t for t in self.cache.keys() if t != self.pinned]
+            if self.pinned is not None:
+                candidates.sort(key = lambda t: -abs(t - self.pinned))
+
+            for kind in ("index", "meshes", "raw", "frame"):
+                for t in candidates:
+                    if total <= self.memory_budget:
+                        return
+
+                    frame = self.cache.get(t)
+                    if frame is None:
+                        continue
+
+                    if kind == "index" and usage[t]["index"] > 0:
+                        frame.drop_indexes()
+                    elif kind == "meshes" and frame.meshes is not None:
+                        frame.drop_meshes()
+                    elif kind == "raw" and usage[t]["raw"] > 0 and self.build_raw is not None:
+                        frame.drop_raw(self.reload_raw)
+                    elif kind == "frame" and not frame.dirty and t != keep:
+                        del self.cache[t]
+                    else:
+                        continue
+
+                    if kind == "frame":
+                        total -= sum(usage[t].values())
+                    else:
+                        total -= usage[t][kind]
+                        usage[t][kind] = 0
+
+                    self.freed[kind] += 1
+
+    ##############################################################################################################################
+
+    def reload_raw(self, frame):
+        self.build_raw(frame, self.load_raw(*self.jobs[frame.t]))
+
+    ##############################################################################################################################
+
+    def statistics(self):
+        memory = self.memory()
+        parts = ", ".join(f"{kind} {memory[kind] / 2**20:.0f} MB" for kind in ("labels", "overseg", "raw", "meshes", "index"))
+        budget = "no budget" if self.memory_budget is None else f"budget {self.memory_budget / 2**20:.0f} MB"
+        freed = ", ".join(f"{kind} {count}" for kind, count in self.freed.items()) or "nothing"
+
+        return f"memory: {parts} ({budget}), freed: {freed}"
+
+    ##############################################################################################################################
+
+    def spill(self, frame):
+
+        if self.scratch_folder is None:
+            self.scratch_folder = tempfile.mkdtemp(prefix = "pyfix3d_")
+            atexit.register(shutil.rmtree, self.scratch_folder, True)
+
+        # The previous files may still be memory-mapped by the frame being spilled, so write new ones
+        previous = self.spilled.get(frame.t)
+        self.spilled[frame.t] = 0 if previous is None else previous + 1
+
+        np.save(self.scratch_path(frame.t, "labels"), self.get_label_array(frame))
+        np.save(self.scratch_path(frame.t, "overseg"), frame.overseg)
+
+        if previous is not None:
+            for name in ("labels", "overseg"):
+                try:
+                    os.remove(self.scratch_path(frame.t, name, previous))
+                except OSError:
+                    pass  # still mapped on Windows; removed with the scratch folder
+
+    ##############################################################################################################################
+
+    def read_spilled(self, t):
+
+        real_img = np.load(self.scratch_path(t, "labels"), mmap_mode = "c")
+
+        current_labels = list(np.unique(real_img))
+        if 0 in current_labels:
+            current_labels.remove(0)
+
+        raw_img = self.load_raw(*self.jobs[t])
+
+        overseg = np.load(self.scratch_path(t, "overseg"), mmap_mode = "c")
+
+        return {"labels": real_img, "unique": current_labels, "overseg": overseg, "raw": raw_img}
+
+    ##############################################################################################################################
+
+    def release_file(self, path):
+        """
+        Replaces memory-mapped arrays backed by the given file with in-memory copies of them,
+        so that the file can be overwritten (e.g. when saving into the folder the images were loaded from).
+        """
+        if not os.path.exists(path):
+            return
+
+        for frame in list(self.cache.values()):
+            overseg = frame.overseg
+            if isinstance(overseg, np.memmap) and overseg.filename is not None and os.path.samefile(overseg.filename, path):
+                frame.overseg = np.array(overseg)
+
+    ##############################################################################################################################
+
+    def scratch_path(self, t, name, generation = None):
+        if generation is None:
+            generation = self.spilled[t]
+        return os.path.join(self.scratch_folder, name + "_" + str(t) + "_" + str(generation) + ".npy")
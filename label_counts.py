@@ -0,0 +1,85 @@
+"""
+    The number of voxels of every label of a frame, counted once when the frame is loaded and then kept up to date
+    by the edits, so that the labels present in a frame are known without looking at the volume again.
+"""
+import numpy as np
+
+class LabelCounts:
+
+    def __init__(self, labels, selection):
+        """
+        :param labels: The segmentation of the frame, any integer numpy array.
+        :param selection: The value of selected voxels (the largest value of the type). They are counted apart, as
+            a table indexed by it could be huge.
+        """
+        self.selection = selection
+
+        values = labels.reshape(-1, order = 'A')
+        selected = values == selection
+        self.selected = int(np.count_nonzero(selected))
+
+        if self.selected > 0:
+            values = values[~selected]
+
+        # bincount only takes types which fit into a signed integer
+        if values.dtype == np.uint64:
+            values = values.astype(np.int64)
+
+        self.counts = np.bincount(values, minlength = 1).astype(np.int64)
+
+    ##############################################################################################################################
+
+    def ensure_capacity(self, label):
+        if label >= len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros(max(label + 1, 2 * len(self.counts)) - len(self.counts), np.int64)])
+
+    ##############################################################################################################################
+
+    def count(self, label):
+        label = int(label)
+        if label == self.selection:
+            return self.selected
+
+        return int(self.counts[label]) if 0 <= label < len(self.counts) else 0
+
+    ##############################################################################################################################
+
+    def present(self):
+        """ The labels with at least one voxel, without 0 and the selection value, in increasing order. """
+        return np.flatnonzero(self.counts[1:]) + 1
+
+    ##############################################################################################################################
+
+    def add(self, values, sign):
+        values = np.asarray(values).ravel()
+        if len(values) == 0:
+            return
+
+        selected = values == self.selection
+        self.selected += sign * int(np.count_nonzero(selected))
+
+        values = values[~selected].astype(np.int64)
+        if len(values) > 0:
+            self.ensure_capacity(int(values.max()))
+            self.counts += sign * np.bincount(values, minlength = len(self.counts))
+
+    ##############################################################################################################################
+
+    def write(self, old_values, new_values):
+        """ Called after voxels holding old_values were set to new_values (arrays of the same length, or a single value). """
+        old_values = np.asarray(old_values).ravel()
+
+        self.add(old_values, -1)
+        self.add(np.broadcast_to(new_values, old_values.shape), 1)
+
+    ##############################################################################################################################
+
+    def merge(self, sources, destination):
+        """ Called after all voxels of the source labels were given the destination label. """
+        sources = [int(source) for source in sources if int(source) != int(destination) and 0 <= int(source) < len(self.counts)]
+        destination = int(destination)
+
+        self.ensure_capacity(destination)
+        moved = int(self.counts[sources].sum())
+        self.counts[sources] = 0
+        self.counts[destination] += moved
@@ -0,0 +1,81 @@
+"""
+    Keeps track of the labels used by the frames and hands out free ones, e.g. for new objects or to
+    replace labels above the allowed maximum.
+"""
+import numpy as np
+
+class LabelPool:
+
+    def __init__(self, max_label = None, scan = None):
+        """
+        :param max_label: Largest label which can be handed out, None for no limit.
+        :param scan: Called once before the first label is handed out, returns the labels of every frame, also of
+            those which were never loaded, so that no label which exists somewhere is handed out.
+        """
+        self.max_label = max_label
+        self.scan = scan
+        self.used = set()
+        self.lowest_free = 1  # every label below it is used
+
+    ##############################################################################################################################
+
+    def add(self, labels):
+        """ Marks labels as used. Only frames which were loaded are known, so call it for every frame. """
+        self.used.update(int(label) for label in labels)
+
+    ##############################################################################################################################
+
+    def take(self):
+        """ Returns the smallest free label and marks it as used, or 0 if there is none left below max_label. """
+        if self.scan is not None:
+            scan, self.scan = self.scan, None
+            # Labels above max_label are replaced when their frame is loaded, by labels taken from here
+            self.add(label for label in scan() if self.max_label is None or label <= self.max_label)
+
+        label = self.lowest_free
+        while label in self.used:
+            label += 1
+
+        if self.max_label is not None and label > self.max_label:
+            return 0
+
+        self.used.add(label)
+        self.lowest_free = label + 1
+
+        return label
+
+    ##############################################################################################################################
+
+    def relabel(self, img, labels):
+        """
+        Replaces the labels of img above max_label by free labels, with one pass over the volume through a lookup table.
+        :param img: The segmentation of a frame.
+        :param labels: Its sorted labels without 0.
+        :return: The new segmentation, its labels and a dictionary from the replaced labels to the new ones.
+        """
+        if self.max_label is None:
+            self.add(labels)
+            return img, labels, {}
+
+        self.add(label for label in labels if label <= self.max_label)
+
+        if len(labels) == 0 or labels[-1] <= self.max_label:
+            return img, labels, {}
+
+        values, inverse = np.unique(img, return_inverse = True)
+
+        mapping = {}
+        lut = values.copy()
+        for i in np.flatnonzero(values > self.max_label):
+            new_label = self.take()
+            if new_label == 0:
+                print("No free labels left, label " + str(values[i]) + " is kept")
+                continue
+
+            mapping[int(values[i])] = new_label
+            lut[i] = new_label
+
+        img = lut[inverse].reshape(img.shape)
+        labels = sorted(set(int(label) for label in lut if label != 0))
+
+        return img, labels, mapping
@@ -0,0 +1,100 @@
+"""
+    Finds the voxels whose centers are projected inside the lasso drawn on the screen with the magic wand, for all
+    voxels at once from the camera's projection matrix instead of casting a ray through every lasso pixel.
+"""
+import numpy as np
+from matplotlib.path import Path
+
+def voxel_projection(renderer, image_data):
+    """
+    The 4x4 matrix from voxel indices (i, j, k, 1) to homogeneous display coordinates, for the active camera of renderer.
+    :return: The matrix, and whether the camera uses a parallel projection (then the last coordinate is always 1).
+    """
+    camera = renderer.GetActiveCamera()
+    composite = camera.GetCompositeProjectionTransformMatrix(renderer.GetTiledAspectRatio(), -1, 1)
+    world_to_view = np.array([[composite.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+    # View coordinates go from -1 to 1 over the viewport
+    x0, y0 = renderer.GetOrigin()
+    width, height = renderer.GetSize()
+    view_to_display = np.array([[width / 2.0, 0, 0, x0 + width / 2.0],
+                                [0, height / 2.0, 0, y0 + height / 2.0],
+                                [0, 0, 1, 0],
+                                [0, 0, 0, 1]])
+
+    index_to_world = np.diag(list(image_data.GetSpacing()) + [1.0])
+    index_to_world[:3, 3] = image_data.GetOrigin()
+
+    return view_to_display @ world_to_view @ index_to_world, bool(camera.GetParallelProjection())
+
+##############################################################################################################################
+
+class Lasso:
+
+    def __init__(self, polygon):
+        """
+        :param polygon: The (x, y) display positions of the lasso, it is closed from the last one to the first.
+        """
+        polygon = np.asarray(polygon, dtype = float)
+
+        # The pixels inside, over the bounding box of the polygon
+        self.corner = np.floor(polygon.min(axis = 0)).astype(np.int64)
+        stop = np.ceil(polygon.max(axis = 0)).astype(np.int64) + 1
+
+        x, y = np.meshgrid(np.arange(self.corner[0], stop[0]), np.arange(self.corner[1], stop[1]))
+        self.mask = Path(polygon).contains_points(np.column_stack([x.ravel(), y.ravel()])).reshape(x.shape)
+
+    ##############################################################################################################################
+
+    def contains(self, x, y):
+        """ Whether the display positions (arrays of the same shape) are inside the lasso. """
+        column = np.round(x).astype(np.int64) - self.corner[0]
+        row = np.round(y).astype(np.int64) - self.corner[1]
+
+        valid = (column >= 0) & (column < self.mask.shape[1]) & (row >= 0) & (row < self.mask.shape[0])
+
+        inside = np.zeros(np.shape(x), dtype = bool)
+        inside[valid] = self.mask[row[valid], column[valid]]
+
+        return inside
+
+    ##############################################################################################################################
+
+    def project(self, points, parallel):
+        """ Whether the homogeneous display coordinates (4 x n) are inside the lasso. Points behind the camera aren't. """
+        x, y, _, w = points
+        if parallel:
+            return self.contains(x, y)
+
+        in_front = w > 0
+        w = np.where(in_front, w, 1.0)
+
+        return self.contains(x / w, y / w) & in_front
+
+    ##############################################################################################################################
+
+    def voxels(self, projection, parallel, dims, candidates = None):
+        """
+        The VTK point ids of the voxels whose centers are projected inside the lasso, at any depth.
+        :param projection: The matrix from voxel_projection.
+        :param dims: The dimensions of the vtkImageData.
+        :param candidates: Point ids to choose from, e.g. the voxels of one label. All voxels if None.
+        """
+        if candidates is not None:
+            ids = np.asarray(candidates, dtype = np.int64)
+            indices = np.vstack(np.unravel_index(ids, dims, order = 'F') + (np.ones(len(ids)),))
+
+            return ids[self.project(projection @ indices, parallel)]
+
+        # Swept along the last axis: one slice is projected, and every next slice is moved by the same step. With a
+        # parallel projection that is just a shift of the same 2D picture, otherwise the depth divides it too.
+        i, j = np.meshgrid(np.arange(dims[0]), np.arange(dims[1]), indexing = 'ij')
+        i, j = i.ravel(order = 'F'), j.ravel(order = 'F')
+        plane = projection[:, 0:1] * i + projection[:, 1:2] * j + projection[:, 3:4]
+
+        selected = []
+        for k in range(dims[2]):
+            inside = self.project(plane + projection[:, 2:3] * k, parallel)
+            selected.append(np.flatnonzero(inside) + k * dims[0] * dims[1])
+
+        return np.concatenate(selected)
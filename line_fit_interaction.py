@@ -44,10 +44,7 @@ class LineFitInteraction(vtk.vtkInteractorStyleTrackballCamera):
         self.chromosome_models = {}
 
         for t in range(visualizer_3d.start_t, visualizer_3d.end_t + 1):
-            self.chromosome_models[t] = {}
-
-            for label in range(0, 256):
-                self.chromosome_models[t][label] = None
+            self.chromosome_models[t] = {}  # label -> model, only for labels which have one
 
     ##############################################################################################################################
 
@@ -168,7 +165,7 @@ class LineFitInteraction(vtk.vtkInteractorStyleTrackballCamera):
        
 
             # Surface object for the selected object or curve, if it's already built
-            fitted_curve = self.chromosome_models[self.visualizer_3d.t][selected_object]
+            fitted_curve = self.chromosome_models[self.visualizer_3d.t].get(selected_object)
             if fitted_curve is not None:
                 surfaceData = fitted_curve.actor.GetMapper().GetInput()
             else:
@@ -284,7 +281,7 @@ class LineFitInteraction(vtk.vtkInteractorStyleTrackballCamera):
 
         t = self.visualizer_3d.t
         label = self.visualizer_3d.destination_color
-        curve = self.chromosome_models[t][label]
+        curve = self.chromosome_models[t].get(label)
         
         if len(self.path) == 0 or curve is None:
             return
@@ -406,7 +403,7 @@ class LineFitInteraction(vtk.vtkInteractorStyleTrackballCamera):
     def delete_active_spline(self):
         
         label = self.visualizer_3d.destination_color
-        curve = self.chromosome_models[self.visualizer_3d.t][label]
+        curve = self.chromosome_models[self.visualizer_3d.t].get(label)
         
         if curve is None:
             return
@@ -0,0 +1,236 @@
+"""
+    Keeps the surfaces of whole frames on disk, so that a frame which was meshed once (in an earlier session, or by
+    warm_cache overnight) is read back instead of meshed again. A frame is found by a hash of its labels, the voxel
+    spacing and the mesh mode, so edited frames simply get a new entry and stale entries are never used.
+    Every entry is one .npz file with the points, triangles and normals of each label. The entries are kept in the
+    cache folder of the user, and the least recently used ones are removed when they take more than MESH_CACHE_BYTES.
+    Usage: python pyfix3d.py --warm-cache <segmentation folder> [spacing x y z] [threshold|discrete]
+"""
+import os
+import sys
+import glob
+import time
+import hashlib
+import threading
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+from frame_loader import label_dtype, read_tiff, replace_atomically
+from meshing import MeshScheduler, MESH_MODES, label_extents, from_polydata, to_polydata
+
+FORMAT_VERSION = 1  # changed whenever the meshing changes what it produces
+
+def user_cache_folder():
+    """ The folder for caches of the current user: LOCALAPPDATA on Windows, ~/Library/Caches on macOS, else XDG_CACHE_HOME or ~/.cache. """
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(base, "pyfix3d", "mesh_cache")
+
+MESH_CACHE_FOLDER = user_cache_folder()
+MESH_CACHE_BYTES = 4 * 1024**3
+
+##############################################################################################################################
+
+class MeshCache:
+
+    def __init__(self, folder = MESH_CACHE_FOLDER, max_bytes = MESH_CACHE_BYTES):
+        """
+        :param folder: Folder of the entries, created when the first one is written.
+        :param max_bytes: Size of the entries above which the least recently used ones are removed, None for no limit.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = None  # bytes of the entries, found by the first trim and counted by store since
+        self.size_lock = threading.Lock()  # the prefetcher's thread stores entries too
+        self.hits = 0
+        self.misses = 0
+
+    ##############################################################################################################################
+
+    def key(self, labels, spacing, mode):
+        """
+        The hash of a (z, y, x) label array with its VTK spacing and the mesh mode. The labels are hashed in the
+        smallest type which holds them, so a frame widened by an edit has the same key after it is saved and loaded.
+        """
+        dtype = label_dtype(int(labels.max()) + 1 if labels.size > 0 else 1)
+        if labels.dtype != dtype:
+            labels = labels.astype(dtype)
+
+        digest = hashlib.blake2b(digest_size = 20)
+        digest.update(repr((FORMAT_VERSION, labels.shape, np.dtype(dtype).str, tuple(float(s) for s in spacing), mode)).encode())
+        # Fortran order is the order of the shared VTK buffer, so no copy is made for the frames of the visualizer
+        digest.update(memoryview(np.asfortranarray(labels).ravel(order = 'F')).cast("B"))
+
+        return digest.hexdigest()
+
+    ##############################################################################################################################
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".npz")
+
+    ##############################################################################################################################
+
+    def has(self, key):
+        return os.path.isfile(self.path(key))
+
+    ##############################################################################################################################
+
+    def load(self, key):
+        """ The dictionary from label to vtkPolyData stored under key, or None if there is no such entry. """
+        path = self.path(key)
+
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+
+        try:
+            with np.load(path) as entry:
+                meshes = {int(label): to_polydata(entry[f"points_{label}"], entry[f"triangles_{label}"], entry[f"normals_{label}"])
+                          for label in entry["labels"]}
+        except Exception as e:
+            # A broken entry is meshed again and overwritten
+            print(f"Mesh cache entry {path} can't be read: {e}")
+            self.misses += 1
+            return None
+
+        # The modification time tells which entries were used last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return meshes
+
+    ##############################################################################################################################
+
+    def store(self, key, meshes):
+        """ Writes the dictionary from label to vtkPolyData under key, replacing an entry with the same key. """
+        arrays = {"labels": np.array(sorted(int(label) for label in meshes.keys()), dtype = np.int64)}
+
+        for label in arrays["labels"]:
+            points, triangles, normals = from_polydata(meshes[label])
+            arrays[f"points_{label}"] = points
+            arrays[f"triangles_{label}"] = triangles
+            arrays[f"normals_{label}"] = normals
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        # np.savez only appends .npz to names without it, so the file object is given instead
+        def write(temp_path):
+            with open(temp_path, "wb") as f:
+                np.savez(f, **arrays)
+
+        if self.max_bytes is None:
+            replace_atomically(path, write)
+            return
+
+        replaced = os.path.getsize(path) if os.path.isfile(path) else 0
+        replace_atomically(path, write)
+
+        # The folder is only looked at again when the counted size goes over the limit
+        with self.size_lock:
+            if self.size is not None:
+                self.size += os.path.getsize(path) - replaced
+            over = self.size is None or self.size > self.max_bytes
+
+        if over:
+            self.trim()
+
+    ##############################################################################################################################
+
+    def trim(self):
+        """
+        Removes the least recently used entries until the cache is within 90% of max_bytes, so that the next stores
+        don't have to do it again. The newest entry is always kept.
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for path in glob.glob(os.path.join(self.folder, "*", "*.npz")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed by another session in the meantime
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        if size > self.max_bytes:
+            for _, entry_size, path in sorted(entries)[:-1]:
+                if size <= 0.9 * self.max_bytes:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= entry_size
+
+        with self.size_lock:
+            self.size = size
+
+    ##############################################################################################################################
+
+    def statistics(self):
+        return f"mesh cache: {self.hits} hits, {self.misses} misses"
+
+##############################################################################################################################
+
+def warm_cache(image_folder, spacing_x = 1.0, spacing_y = 1.0, spacing_z = 1.0, mode = "threshold", folder = MESH_CACHE_FOLDER, threads = None):
+    """
+    Meshes every frame of a folder of TIF stacks which isn't in the cache yet, e.g. overnight before curation.
+    The frames are prepared like the visualizer does without max_label, so it finds the entries when it loads them.
+    """
+    cache = MeshCache(folder)
+    scheduler = MeshScheduler(threads)
+    spacing = (spacing_z, spacing_y, spacing_x)  # the order of the vtkImageData
+
+    for file in sorted(glob.glob(os.path.join(image_folder, "*.tif"))):
+        start_time = time.time()
+
+        img = read_tiff(file, "r")
+        max_label = int(img.max()) if img.size > 0 else 0
+        labels = np.asfortranarray(img, dtype = label_dtype(max_label + 1))
+
+        key = cache.key(labels, spacing, mode)
+        if cache.has(key):
+            print(f"Cached already: {file}")
+            continue
+
+        image_data = vtk.vtkImageData()
+        image_data.SetDimensions(labels.shape)
+        image_data.SetSpacing(*spacing)
+        image_data.GetPointData().SetScalars(numpy_to_vtk(num_array = labels.ravel(order = 'F'), deep = False))
+
+        boxes = label_extents(labels, max_label)
+        cache.store(key, scheduler.mesh(image_data, sorted(boxes.keys()), mode, boxes, urgent = False))
+
+        print(f"Cached {len(boxes)} labels of {file} in {time.time() - start_time:.2f} s")
+
+##############################################################################################################################
+
+def warm_cache_main(arguments):
+    """ The command line of warm_cache: <segmentation folder> [spacing x y z] [threshold|discrete] """
+    arguments = list(arguments)
+
+    if len(arguments) not in (1, 2, 4, 5) or (len(arguments) in (2, 5) and arguments[-1] not in MESH_MODES):
+        print("Usage: python pyfix3d.py --warm-cache <segmentation folder> [spacing x y z] [threshold|discrete]")
+        sys.exit(1)
+
+    mode = arguments.pop() if len(arguments) in (2, 5) else "threshold"
+    spacing = [float(s) for s in arguments[1:]] if len(arguments) == 4 else [1.0, 1.0, 1.0]
+
+    warm_cache(arguments[0], *spacing, mode = mode)
+
+##############################################################################################################################
+
+if __name__ == "__main__":
+    warm_cache_main(sys.argv[1:])
@@ -0,0 +1,580 @@
+"""
+    Builds the surfaces of the labels of a segmentation (vtkImageData with integer labels).
+    Two modes are available:
+    'threshold': every label is thresholded and meshed on its own (two passes over the volume per label).
+    'discrete': all labels are meshed in one pass over the volume, and the result is split by label.
+    Given the bounding boxes of the labels, only the part of the volume around them is visited.
+    Coarser levels of detail of the surfaces are made by decimation, to be shown while the camera moves.
+    After an edit, the threshold mode can rebuild a surface block by block, only in the blocks around the edit.
+"""
+import os
+import vtk
+import queue
+import itertools
+import threading
+import traceback
+import numpy as np
+from concurrent.futures import Future
+from scipy.ndimage import find_objects
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+MESH_MODES = ("threshold", "discrete")
+
+# Fraction of the triangles removed at each level of detail after the full one, and the size below which
+# a surface is cheap enough to be kept as it is at every level
+LOD_REDUCTIONS = (0.75, 0.95)
+LOD_MIN_TRIANGLES = 1000
+
+# Edge length in voxels of the blocks surfaces are rebuilt in after edits
+BLOCK_SIZE = 32
+
+##############################################################################################################################
+
+def label_extents(labels, max_label):
+    """
+    The bounding box of every label of a (z, y, x) array, as a tuple of slices, in one pass over the array.
+    Labels above max_label are ignored.
+    """
+    boxes = find_objects(labels, max_label)
+    return {label + 1: box for label, box in enumerate(boxes) if box is not None}
+
+##############################################################################################################################
+
+def box_of_points(points):
+    """ The bounding box of an (n, 3) array of (i, j, k) voxel indices. """
+    points = np.asarray(points)
+    return tuple(slice(int(low), int(high) + 1) for low, high in zip(points.min(axis = 0), points.max(axis = 0)))
+
+##############################################################################################################################
+
+def box_of_mask(mask):
+    """ The bounding box of the True voxels of a (z, y, x) mask, None if there are none. """
+    box = []
+    for axis in range(mask.ndim):
+        indices = np.flatnonzero(mask.any(axis = tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(indices) == 0:
+            return None
+        box.append(slice(int(indices[0]), int(indices[-1]) + 1))
+
+    return tuple(box)
+
+##############################################################################################################################
+
+def union_box(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    return tuple(slice(min(x.start, y.start), max(x.stop, y.stop)) for x, y in zip(a, b))
+
+##############################################################################################################################
+
+def boxes_overlap(a, b):
+    return all(x.start < y.stop and y.start < x.stop for x, y in zip(a, b))
+
+##############################################################################################################################
+
+def crop(image_data, box, padding = 1):
+    """
+    The part of image_data inside box, grown by padding voxels so that the surfaces inside are closed. The
+    extent of the result keeps the indices of the full volume, so meshes built from it are in world coordinates.
+    """
+    if box is None:
+        return image_data
+
+    dims = image_data.GetDimensions()
+    voi = []
+    for axis, part in enumerate(box):
+        voi += [max(part.start - padding, 0), min(part.stop - 1 + padding, dims[axis] - 1)]
+
+    extract = vtk.vtkExtractVOI()
+    extract.SetInputData(image_data)
+    extract.SetVOI(*voi)
+    extract.Update()
+
+    return extract.GetOutput()
+
+##############################################################################################################################
+
+def mesh_labels(image_data, labels, mode = "threshold", boxes = None):
+    """
+    :param image_data: vtkImageData with the labels as point scalars.
+    :param labels: The labels to mesh.
+    :param mode: One of MESH_MODES.
+    :param boxes: Optional dictionary from label to its bounding box (see label_extents), or to None if it isn't known.
+        Labels missing from it are taken as absent from the volume and get an empty surface without any work.
+    :return: Dictionary from label to vtkPolyData. Labels which aren't in the volume get an empty surface.
+    """
+    if boxes is None:
+        boxes = {label: None for label in labels}
+
+    meshes = {label: vtk.vtkPolyData() for label in labels if label not in boxes}
+    labels = [label for label in labels if label in boxes]
+
+    if mode == "threshold":
+        meshes.update(mesh_labels_threshold(image_data, labels, boxes))
+    elif mode == "discrete":
+        meshes.update(mesh_labels_discrete(image_data, labels, boxes))
+    else:
+        raise ValueError("unknown mesh mode: " + str(mode))
+
+    return meshes
+
+##############################################################################################################################
+
+def mesh_labels_threshold(image_data, labels, boxes, padding = 1):
+
+    meshes = {}
+
+    thresholdFilter = vtk.vtkImageThreshold()
+
+    for label in labels:
+        # Only the part of the volume around the label is thresholded and meshed
+        thresholdFilter.SetInputData(crop(image_data, boxes[label], padding))
+
+        # Threshold the volume data to create a binary mask for the current label
+        thresholdFilter.ThresholdBetween(label, label)
+        thresholdFilter.SetInValue(1)
+        thresholdFilter.SetOutValue(0)
+        thresholdFilter.Update()
+
+        # Apply Marching Cubes on the binary mask to generate vtkPolyData
+        marchingCubes = vtk.vtkFlyingEdges3D()
+        marchingCubes.SetInputData(thresholdFilter.GetOutput())
+        marchingCubes.SetValue(0, 0.5)  # Generate surface for the thresholded value
+        marchingCubes.Update()
+
+        meshes[label] = marchingCubes.GetOutput()
+
+    return meshes
+
+##############################################################################################################################
+
+def mesh_labels_discrete(image_data, labels, boxes):
+    """
+    Meshes all labels at once with vtkSurfaceNets3D, which visits the volume once for any number of labels.
+    Each boundary triangle knows the two labels it separates, so it is given to both. Older VTK versions
+    without it use vtkDiscreteFlyingEdges3D, where every triangle belongs to one label.
+    Only the box around all the labels is visited.
+    """
+    labels = list(labels)
+    if len(labels) == 0:
+        return {}
+
+    box = boxes[labels[0]]
+    for label in labels[1:]:
+        box = union_box(box, boxes[label]) if box is not None and boxes[label] is not None else None
+
+    image_data = crop(image_data, box)
+
+    if hasattr(vtk, "vtkSurfaceNets3D"):
+        surfaceNets = vtk.vtkSurfaceNets3D()
+        surfaceNets.SetInputData(image_data)
+        for i, label in enumerate(labels):
+            surfaceNets.SetValue(i, label)
+        surfaceNets.SetBackgroundLabel(0)
+        surfaceNets.SetOutputMeshTypeToTriangles()
+        surfaceNets.SmoothingOff()  # like the threshold mode, the surfaces follow the voxels
+        surfaceNets.Update()
+
+        output = surfaceNets.GetOutput()
+        cell_labels = vtk_to_numpy(output.GetCellData().GetArray("BoundaryLabels")).reshape(output.GetNumberOfCells(), -1)
+    else:
+        flyingEdges = vtk.vtkDiscreteFlyingEdges3D()
+        flyingEdges.SetInputData(image_data)
+        for i, label in enumerate(labels):
+            flyingEdges.SetValue(i, label)
+        flyingEdges.ComputeNormalsOff()
+        flyingEdges.ComputeScalarsOn()
+        flyingEdges.Update()
+
+        output = flyingEdges.GetOutput()
+        point_labels = vtk_to_numpy(output.GetPointData().GetScalars())
+        triangles = vtk_to_numpy(output.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        cell_labels = point_labels[triangles[:, 0]].reshape(-1, 1)
+
+    return split_by_label(output, cell_labels, labels)
+
+##############################################################################################################################
+
+def split_by_label(polydata, cell_labels, labels):
+    """
+    Splits a triangle mesh into one mesh per label, keeping only the points each of them uses.
+    :param cell_labels: Array with one row per triangle, with the labels the triangle belongs to.
+    """
+    meshes = {label: vtk.vtkPolyData() for label in labels}
+
+    if polydata.GetNumberOfCells() == 0:
+        return meshes
+
+    points = vtk_to_numpy(polydata.GetPoints().GetData())
+    triangles = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+    # One entry per (triangle, label) pair, sorted by label
+    cells = np.tile(np.arange(len(triangles)), cell_labels.shape[1])
+    owners = cell_labels.T.ravel()
+    order = np.argsort(owners, kind = "stable")
+    cells, owners = cells[order], owners[order]
+
+    values, starts = np.unique(owners, return_index = True)
+    ends = np.append(starts[1:], len(owners))
+
+    for value, start, end in zip(values, starts, ends):
+        label = value.item()
+        if label not in meshes:
+            continue  # background, or a label which wasn't asked for
+
+        label_triangles = triangles[cells[start:end]]
+        point_ids, connectivity = np.unique(label_triangles, return_inverse = True)
+
+        meshes[label] = make_polydata(points[point_ids], connectivity.reshape(-1))
+
+    return meshes
+
+##############################################################################################################################
+
+def make_polydata(points, connectivity):
+    """ A triangle mesh from an (n, 3) array of points and the point ids of its triangles, with normals for shading. """
+
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(np.ascontiguousarray(points, dtype = np.float32), deep = True))
+
+    offsets = np.arange(0, len(connectivity) + 1, 3, dtype = np.int64)
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_to_vtk(offsets, deep = True, array_type = vtk.VTK_ID_TYPE),
+                  numpy_to_vtk(connectivity.astype(np.int64), deep = True, array_type = vtk.VTK_ID_TYPE))
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    polydata.SetPolys(polys)
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(polydata)
+    normals.SplittingOff()
+    normals.Update()
+
+    return normals.GetOutput()
+
+##############################################################################################################################
+
+def from_polydata(polydata):
+    """ The points, triangles and point normals of a triangle mesh as compact numpy arrays. """
+    if polydata.GetNumberOfPoints() == 0 or polydata.GetNumberOfCells() == 0:
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int32), np.zeros((0, 3), np.float32)
+
+    points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float32)
+    triangles = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray()).reshape(-1, 3).astype(np.int32)
+
+    normals = polydata.GetPointData().GetNormals()
+    normals = np.zeros((0, 3), np.float32) if normals is None else vtk_to_numpy(normals).astype(np.float32)
+
+    return points, triangles, normals
+
+##############################################################################################################################
+
+def to_polydata(points, triangles, normals):
+    """ The vtkPolyData of arrays written by from_polydata. Normals are only computed if they weren't stored. """
+    if len(triangles) == 0:
+        return vtk.vtkPolyData()
+
+    if len(normals) != len(points):
+        return make_polydata(points, triangles.reshape(-1))
+
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_to_vtk(points, deep = True))
+
+    offsets = np.arange(0, triangles.size + 1, 3, dtype = np.int64)
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_to_vtk(offsets, deep = True, array_type = vtk.VTK_ID_TYPE),
+                  numpy_to_vtk(triangles.reshape(-1).astype(np.int64), deep = True, array_type = vtk.VTK_ID_TYPE))
+
+    vtk_normals = numpy_to_vtk(normals, deep = True)
+    vtk_normals.SetName("Normals")
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtk_points)
+    polydata.SetPolys(polys)
+    polydata.GetPointData().SetNormals(vtk_normals)
+
+    return polydata
+
+##############################################################################################################################
+
+def combine_meshes(meshes, offsets = None):
+    """
+    The surfaces of several labels as one triangle mesh, with the label of every triangle as the cell array 'Label'.
+    :param meshes: List of (label, vtkPolyData).
+    :param offsets: Dictionary from label to the (x, y, z) translation of its surface, for the labels which were moved.
+    """
+    points, triangles, normals, cell_labels = [], [], [], []
+    offset = 0
+
+    for label, mesh in meshes:
+        if mesh.GetNumberOfCells() == 0:
+            continue
+
+        mesh_points, mesh_triangles, mesh_normals = from_polydata(mesh)
+        if offsets is not None and label in offsets:
+            mesh_points = mesh_points + np.asarray(offsets[label], dtype = mesh_points.dtype)
+        points.append(mesh_points)
+        triangles.append(mesh_triangles.astype(np.int64) + offset)
+        normals.append(mesh_normals)
+        cell_labels.append(np.full(len(mesh_triangles), label, dtype = np.int64))
+        offset += len(mesh_points)
+
+    if len(points) == 0:
+        return vtk.vtkPolyData()
+
+    # If a surface has no normals, they are computed again for all
+    if any(len(n) != len(p) for n, p in zip(normals, points)):
+        normals = [np.zeros((0, 3), np.float32)]
+
+    polydata = to_polydata(np.concatenate(points), np.concatenate(triangles), np.concatenate(normals))
+    cell_labels = np.concatenate(cell_labels)
+
+    vtk_labels = numpy_to_vtk(cell_labels, deep = True)
+    vtk_labels.SetName("Label")
+    polydata.GetCellData().AddArray(vtk_labels)
+
+    return polydata
+
+##############################################################################################################################
+
+def block_indices(box, dims, block_size = BLOCK_SIZE):
+    """
+    The indices of the blocks whose surfaces change when the voxels inside box change. Block (a, b, c) holds the cells
+    (cubes between 8 voxels) a * block_size to (a + 1) * block_size - 1 along the first axis, and so on, so the blocks
+    don't share triangles. A voxel is a corner of the cells before and after it.
+    """
+    ranges = []
+    for part, size in zip(box, dims):
+        first = max(part.start - 1, 0) // block_size
+        last = min(part.stop - 1, size - 2) // block_size
+        ranges.append(range(first, last + 1))
+
+    return list(itertools.product(*ranges))
+
+##############################################################################################################################
+
+def block_box(index, dims, block_size = BLOCK_SIZE):
+    """ The voxels at the corners of the cells of a block, shared with the next blocks. """
+    return tuple(slice(i * block_size, min((i + 1) * block_size + 1, size)) for i, size in zip(index, dims))
+
+##############################################################################################################################
+
+def mesh_blocks(image_data, blocks):
+    """
+    Meshes labels like the threshold mode, but separately inside each block. Together the blocks of a label give
+    the same triangles as meshing it at once, so after an edit only the blocks around it have to be meshed again.
+    :param blocks: Dictionary from label to the indices of the blocks to mesh.
+    :return: Dictionary from label to a dictionary from block index to vtkPolyData.
+    """
+    dims = image_data.GetDimensions()
+    meshes = {}
+
+    for label, indices in blocks.items():
+        meshes[label] = {index: mesh_labels_threshold(image_data, [label], {label: block_box(index, dims)}, padding = 0)[label]
+                         for index in indices}
+
+    return meshes
+
+##############################################################################################################################
+
+def append_meshes(meshes):
+    """
+    One vtkPolyData with the triangles of all the meshes, e.g. the blocks of a label. Neighbouring blocks share the
+    voxels on their faces, so the points along the seams come once from each block: they are merged into one point,
+    with the mean of their normals, otherwise the shading would show the seams.
+    """
+    meshes = [mesh for mesh in meshes if mesh.GetNumberOfCells() > 0]
+
+    if len(meshes) == 0:
+        return vtk.vtkPolyData()
+    if len(meshes) == 1:
+        return meshes[0]
+
+    append = vtk.vtkAppendPolyData()
+    for mesh in meshes:
+        append.AddInputData(mesh)
+    append.Update()
+
+    points, triangles, normals = from_polydata(append.GetOutput())
+    points, inverse = np.unique(points, axis = 0, return_inverse = True)
+    inverse = inverse.reshape(-1)
+
+    # Without normals in every block, to_polydata computes them on the merged surface
+    if len(normals) == len(inverse):
+        merged = np.zeros_like(points)
+        np.add.at(merged, inverse, normals)
+        lengths = np.linalg.norm(merged, axis = 1, keepdims = True)
+        normals = merged / np.maximum(lengths, 1e-12)
+
+    return to_polydata(points, inverse[triangles].astype(np.int32), normals)
+
+##############################################################################################################################
+
+def decimate(polydata, reductions = LOD_REDUCTIONS):
+    """ The coarser levels of detail of a surface, one per reduction. Small surfaces are returned unchanged. """
+    if polydata.GetNumberOfCells() < LOD_MIN_TRIANGLES:
+        return [polydata] * len(reductions)
+
+    levels = []
+    for reduction in reductions:
+        decimation = vtk.vtkQuadricDecimation()
+        decimation.SetInputData(polydata)
+        decimation.SetTargetReduction(reduction)
+        decimation.VolumePreservationOn()
+        decimation.Update()
+
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputData(decimation.GetOutput())
+        normals.SplittingOff()
+        normals.Update()
+
+        levels.append(normals.GetOutput())
+
+    return levels
+
+##############################################################################################################################
+
+def decimate_labels(meshes, reductions = LOD_REDUCTIONS):
+    """ The levels of detail of a dictionary from label to vtkPolyData, as a dictionary from label to list of levels. """
+    return {label: decimate(polydata, reductions) for label, polydata in meshes.items()}
+
+##############################################################################################################################
+
+class MeshScheduler:
+    """
+    Meshes labels with a pool of threads (the VTK filters don't hold the GIL while they run). Work for corrections
+    is urgent and starts before queued background work, e.g. from the prefetcher. Results are returned in the
+    order of the labels, whatever order the threads finish in.
+    """
+
+    URGENT = 0
+    BACKGROUND = 1
+
+    def __init__(self, threads = None):
+        """
+        :param threads: Number of threads, None for one per core. 1 meshes in the calling thread.
+        """
+        if threads is None:
+            threads = os.cpu_count() or 1
+        self.threads = max(1, int(threads))
+
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()  # first in, first out for the same priority
+        self.workers = []
+
+    ##############################################################################################################################
+
+    def start(self):
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target = self.run, daemon = True)
+            worker.start()
+            self.workers.append(worker)
+
+    ##############################################################################################################################
+
+    def run(self):
+        while True:
+            priority, order, future, function, arguments = self.queue.get()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(function(*arguments))
+            except BaseException as e:
+                traceback.print_exc()
+                future.set_exception(e)
+
+    ##############################################################################################################################
+
+    def submit(self, image_data, labels, mode = "threshold", boxes = None, urgent = True):
+        """
+        Queues the meshing of labels, split into a few jobs per thread (see split). The discrete mode meshes all labels
+        in one pass, so it stays a single job.
+        :return: A list of futures, to be given to gather.
+        """
+        groups = self.split(labels, single = mode == "discrete")
+
+        futures = []
+        for group in groups:
+            arguments = (image_data, group, mode, None if boxes is None else {label: boxes[label] for label in group if label in boxes})
+            futures.append((group, self.submit_job(mesh_labels, arguments, urgent, inline = self.threads == 1)))
+
+        return futures
+
+    ##############################################################################################################################
+
+    def submit_blocks(self, image_data, blocks, urgent = True):
+        """
+        Queues the meshing of labels inside some of their blocks (see mesh_blocks), split into jobs like submit.
+        :param blocks: Dictionary from label to the indices of the blocks to mesh.
+        :return: A list of futures, to be given to gather.
+        """
+        futures = []
+        for group in self.split(blocks.keys()):
+            arguments = (image_data, {label: blocks[label] for label in group})
+            futures.append((group, self.submit_job(mesh_blocks, arguments, urgent, inline = self.threads == 1)))
+
+        return futures
+
+    ##############################################################################################################################
+
+    def submit_decimation(self, meshes):
+        """
+        Queues the building of the levels of detail of a dictionary from label to vtkPolyData (see decimate). It is always
+        background work on the threads, also with a single thread, as the full surfaces can be shown until it is done.
+        :return: A list of futures, each with a dictionary from label to its list of levels.
+        """
+        groups = self.split(list(meshes.keys()))
+        return [self.submit_job(decimate_labels, ({label: meshes[label] for label in group},), urgent = False) for group in groups]
+
+    ##############################################################################################################################
+
+    def split(self, labels, single = False):
+        """ Splits labels into a few jobs per thread, so that urgent work doesn't wait long for a free thread. """
+        labels = list(labels)
+
+        if self.threads == 1 or single or len(labels) <= 1:
+            return [labels]
+
+        count = 4 * self.threads
+        groups = [labels[i::count] for i in range(count)]
+        return [group for group in groups if len(group) > 0]
+
+    ##############################################################################################################################
+
+    def submit_job(self, function, arguments, urgent = True, inline = False):
+        """ Runs function(*arguments) on the threads, or right away in the calling thread if inline. Returns its Future. """
+        future = Future()
+
+        if inline:
+            future.set_result(function(*arguments))
+            return future
+
+        priority = self.URGENT if urgent else self.BACKGROUND
+        self.queue.put((priority, next(self.order), future, function, arguments))
+        self.start()
+
+        return future
+
+    ##############################################################################################################################
+
+    def gather(self, futures):
+        """ Waits for the jobs of submit and returns a dictionary from label to vtkPolyData, in the order of the labels. """
+        results = [(group, future.result()) for group, future in futures]
+
+        labels = sorted(label for group, meshes in results for label in group)
+        meshes = {}
+        for group, result in results:
+            meshes.update(result)
+
+        return {label: meshes[label] for label in labels}
+
+    ##############################################################################################################################
+
+    def mesh(self, image_data, labels, mode = "threshold", boxes = None, urgent = True):
+        return self.gather(self.submit(image_data, labels, mode, boxes, urgent))
@@ -0,0 +1,144 @@
+"""
+    Prepares the time points next to the shown one in a background thread (decoding, labels and meshes),
+    so that moving through time doesn't have to wait for them.
+"""
+import time
+import threading
+import traceback
+from collections import deque
+
+class Prefetcher:
+
+    def __init__(self, frames, prepare, depth = 2):
+        """
+        :param frames: The FrameStore of the visualizer.
+        :param prepare: Called with a time point in the background thread after its frame is loaded, e.g. to build the meshes.
+        :param depth: How many time points are prepared ahead when moving steadily in one direction. 0 disables prefetching.
+        """
+        self.frames = frames
+        self.prepare = prepare
+        self.depth = max(0, int(depth))
+
+        self.condition = threading.Condition()
+        self.queue = []     # time points still to prepare, most urgent first
+        self.ready = set()  # prepared in the background and not shown yet
+        self.busy = None    # time point being prepared
+        self.thread = None
+
+        self.current = None
+        self.steps = deque(maxlen = 3)  # the last moves, to find the direction of navigation
+
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0.0
+
+    ##############################################################################################################################
+
+    def show(self, t):
+        """
+        Called before time point t is shown. Waits if t is being prepared right now, and starts preparing its neighbours.
+        """
+        with self.condition:
+            if t != self.current:
+                if t in self.ready and self.frames.is_loaded(t):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+
+                if self.current is not None:
+                    self.steps.append(t - self.current)
+                self.current = t
+
+                # Better to wait for the background thread than to do the same work twice
+                start_time = time.time()
+                while self.busy == t:
+                    self.condition.wait()
+                self.wait_time += time.time() - start_time
+
+                self.ready.discard(t)
+
+            self.frames.pinned = t
+
+        self.schedule()
+
+    ##############################################################################################################################
+
+    def targets(self):
+        """ The time points to prepare around the current one, most urgent first. """
+        if self.depth == 0 or self.current is None:
+            return []
+
+        # Moving steadily in one direction: prepare far ahead and one behind. Otherwise the same on both sides.
+        direction = 1
+        ahead = behind = max(1, self.depth // 2)
+
+        if len(self.steps) > 0:
+            direction = 1 if self.steps[-1] > 0 else -1
+            recent = list(self.steps)[-2:]
+            if all(step * direction > 0 for step in recent):
+                ahead, behind = self.depth, 1
+
+        # The current frame is pinned, so it doesn't take up room
+        room = self.frames.cache_size
+
+        targets = []
+        for distance in range(1, max(ahead, behind) + 1):
+            if distance <= ahead:
+                targets.append(self.current + direction * distance)
+            if distance <= behind:
+                targets.append(self.current - direction * distance)
+
+        return [t for t in targets if 0 <= t < len(self.frames)][:room]
+
+    ##############################################################################################################################
+
+    def schedule(self):
+
+        with self.condition:
+            self.queue = [t for t in self.targets() if t != self.busy]
+
+            if len(self.queue) > 0 and self.thread is None:
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+
+    ##############################################################################################################################
+
+    def cancel(self):
+        """ Drops the queued time points and waits for the one being prepared, before frames are changed in bulk. """
+        with self.condition:
+            self.queue = []
+            while self.busy is not None:
+                self.condition.wait()
+
+    ##############################################################################################################################
+
+    def run(self):
+
+        while True:
+            with self.condition:
+                if len(self.queue) == 0:
+                    self.thread = None
+                    return
+
+                t = self.queue.pop(0)
+                self.busy = t
+
+            try:
+                self.frames.preload(t)
+                self.prepare(t)
+
+                with self.condition:
+                    self.ready.add(t)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.busy = None
+                    self.condition.notify_all()
+
+    ##############################################################################################################################
+
+    def statistics(self):
+        shown = self.hits + self.misses
+        rate = 100.0 * self.hits / shown if shown > 0 else 0.0
+        return f"prefetch: {self.hits} hits, {self.misses} misses ({rate:.0f}% hits), {self.wait_time:.2f} s waited"
@@ -1,4 +1,6 @@
+import sys
 import time
+import argparse
 import traceback
 
 def retry_operation(operation, attempts = 6, delay = 10):
@@ -22,10 +24,40 @@ def retry_operation(operation, attempts = 6, delay = 10):
             else:
                 raise  # Reraises the last exception if out of attempts
 
-from visualizer import *
-from visualizer_gui import *
+def parse_options(arguments):
+    """
+    The options of Visualizer_3D given on the command line, e.g. python pyfix3d.py --workers 4 --memory-budget 4000.
+    Only the options which were given are returned, the others keep the defaults of Visualizer_3D.
+    """
+    parser = argparse.ArgumentParser(description = "Pyfix3d, correction of segmentation labels in 3D. The folders are chosen in the window which opens.")
+    parser.add_argument("--workers", type = int, help = "worker processes loading frames, 1 loads them in the application (default: all cores)")
+    parser.add_argument("--cache-size", type = int, help = "frames kept in memory besides the shown one (default: 8)")
+    parser.add_argument("--memory-budget", type = float, help = "megabytes the frames in memory may hold with their surfaces (default: no limit)")
+    parser.add_argument("--no-memmap", dest = "memmap", action = "store_const", const = False, help = "read TIF files into memory instead of memory-mapping them")
+    parser.add_argument("--prefetch", type = int, help = "frames prepared in the background ahead of the shown one, 0 disables it (default: 2)")
+    parser.add_argument("--max-label", type = int, help = "labels above it are replaced by free labels at loading (default: no limit)")
+    parser.add_argument("--compression", choices = ("zlib", "zstd"), help = "compression of the saved TIF files (default: none)")
+    parser.add_argument("--mesh-mode", choices = ("threshold", "discrete"), help = "how the surfaces are built (default: threshold)")
+    parser.add_argument("--mesh-threads", type = int, help = "threads building surfaces (default: all cores)")
+    parser.add_argument("--mesh-cache", help = "folder of the surfaces kept between sessions (default: in the cache folder of the user)")
+    parser.add_argument("--no-mesh-cache", action = "store_true", help = "always mesh, without the mesh cache")
+    parser.add_argument("--target-fps", type = float, help = "frame rate kept while the camera moves, 0 always shows the full surfaces (default: 10)")
+    parser.add_argument("--render-mode", choices = ("actors", "lut"), help = "one actor per label, or all labels in one mesh colored by a lookup table (default: actors)")
+
+    options = {name: value for name, value in vars(parser.parse_args(arguments)).items() if value is not None}
 
-def initialize_visualizer(user_values):
+    if options.pop("no_mesh_cache"):
+        options["mesh_cache"] = None
+    if options.get("target_fps") == 0:
+        options["target_fps"] = None
+
+    return options
+
+def initialize_visualizer(user_values, options = None):
+    """
+    :param user_values: The folders, time points and spacing chosen in the start window.
+    :param options: The other arguments of Visualizer_3D, see parse_options.
+    """
 
     visualizer = Visualizer_3D(user_values[0] + "/*.tif",
                                     user_values[1] + "/*.tif",
@@ -35,14 +67,30 @@ def initialize_visualizer(user_values):
                                     int(user_values[5]),
                                     spacing_x = float(user_values[6]),
                                     spacing_y = float(user_values[7]),
-                                    spacing_z = float(user_values[8]))
+                                    spacing_z = float(user_values[8]),
+                                    **(options or {}))
 
     visualizer.start()
     return visualizer
 
-user_values = PathChoice().prompt()
+# The loader uses worker processes, which re-import this module; only the main process imports VTK and Tk and opens the GUI
+if __name__ == "__main__":
+
+    from visualizer import *
+    from visualizer_gui import *
+    from mesh_cache import warm_cache_main
+
+    # python pyfix3d.py --warm-cache <segmentation folder> ... meshes a dataset into the mesh cache without the GUI
+    if sys.argv[1:2] == ["--warm-cache"]:
+        warm_cache_main(sys.argv[2:])
+        sys.exit(0)
+
+    # Checked before the start window opens, so a mistyped option doesn't wait for it
+    options = parse_options(sys.argv[1:])
+
+    user_values = PathChoice().prompt()
 
-initialize_visualizer(user_values)
+    initialize_visualizer(user_values, options)
 
 """
 
@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_store import FrameStore
+
+##############################################################################################################################
+
+def load(t):
+    labels = np.full((2, 3, 4), t + 1, dtype = np.uint8)
+    return {"labels": labels, "unique": [t + 1], "overseg": labels.copy(), "raw": None}
+
+def load_raw(t):
+    return None
+
+def build_frame(frame, decoded):
+    frame.labels = np.array(decoded["labels"])
+    frame.overseg = decoded["overseg"]
+
+def make_store(cache_size, memory_budget = None):
+    return FrameStore([(t,) for t in range(4)], build_frame, lambda frame: frame.labels, cache_size, workers = 1,
+                      load = load, load_raw = load_raw, memory_budget = memory_budget)
+
+##############################################################################################################################
+
+def test_edits_survive_eviction_with_one_frame_and_a_pin():
+    store = make_store(cache_size = 1)
+    store.pinned = 0
+    store.get(0)
+
+    for t in store.iterate(range(4)):
+        store.get(t).labels[:] = 9
+        store.mark_dirty(t)
+
+    assert store.is_loaded(0)
+    for t in range(4):
+        assert np.all(store.get(t).labels == 9)
+
+def test_frame_being_added_is_not_evicted():
+    store = make_store(cache_size = 1)
+    store.pinned = 0
+    store.get(0)
+
+    frame = store.get(1)
+    assert store.is_loaded(0) and store.is_loaded(1)
+
+    frame.labels[:] = 7
+    store.mark_dirty(1)
+    store.get(2)
+
+    assert not store.is_loaded(1)
+    assert np.all(store.get(1).labels == 7)
+
+def test_frame_being_added_is_not_dropped_for_the_memory_budget():
+    store = make_store(cache_size = 4, memory_budget = 1)
+    store.pinned = 0
+    store.get(0)
+
+    for t in store.iterate(range(1, 4)):
+        frame = store.get(t)
+        frame.labels[:] = 5
+        store.mark_dirty(t)
+
+        assert store.get(t) is frame
+
+    for t in range(1, 4):
+        assert np.all(store.get(t).labels == 5)
@@ -4,16 +4,28 @@
     05/03/2024
 """
 import vtk
-from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
-from tifffile import imread, imwrite
+from vtk.util.numpy_support import numpy_to_vtk
 import glob
 import numpy as np
 import tkinter as tk
 import os
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial import cKDTree
 import networkx as nx
 from visualizer_gui import *
 from custom_interaction import *
+from frame_loader import split_overseg_labels_spanning_several_real, label_dtype, write_tiff, copy_tiff
+from frame_store import FrameStore, FrameView
+from chunk_store import ChunkStore, is_chunk_store, load_store_frame, load_store_raw, load_store_labels
+from prefetch import Prefetcher
+from label_pool import LabelPool
+from label_counts import LabelCounts
+from chunk_index import ChunkIndex
+from voxel_index import VoxelIndex
+from meshing import MeshScheduler, MESH_MODES, LOD_REDUCTIONS, LOD_MIN_TRIANGLES, label_extents, box_of_points, box_of_mask, union_box, boxes_overlap
+from meshing import block_indices, block_box, append_meshes, combine_meshes
+from mesh_cache import MeshCache, MESH_CACHE_FOLDER
+import csv
 from line_fit_interaction import *
 from random import choices, choice, uniform
 import time
@@ -24,24 +36,53 @@ if vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads() > 4:
     vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(4)
 
 class Visualizer_3D:
-    def __init__(self, folder, overseg_folder, raw_folder, start, end, interval, spacing_x = 1.0, spacing_y = 1.0, spacing_z = 1.0):
+    def __init__(self, folder, overseg_folder, raw_folder, start, end, interval, spacing_x = 1.0, spacing_y = 1.0, spacing_z = 1.0, workers = None, cache_size = 8, memmap = True, max_label = None, compression = None, prefetch = 2, mesh_mode = "threshold", mesh_threads = None, mesh_cache = MESH_CACHE_FOLDER, target_fps = 10, memory_budget = None, render_mode = "actors"):
         """
         Initializes the 3D visualizer with image data and oversegmentation data from the provided folder paths.
         Configures spacing between voxels along each axis and prepares initial rendering setup.
-        :param folder: Path to folder containing the original TIF images.
+        :param folder: Path to folder containing the original TIF images. It can also be a chunk store (see chunk_store.py)
+            holding the labels, overseg and raw data, the other folders are then ignored.
         :param overseg_folder: Path to folder containing over-segmentation files.
         :param spacing_x: Spacing between voxels in x-axis.
         :param spacing_y: Spacing between voxels in y-axis.
         :param spacing_z: Spacing between voxels in z-axis.
+        :param workers: Number of worker processes used to load the images. None uses all cores, 1 loads in this process.
+        :param cache_size: Number of time points kept in memory. The others are loaded when they are shown.
+        :param memmap: Memory-map uncompressed TIF files instead of reading them into memory. The raw data stays mapped,
+            the labels are still copied in full into Fortran order when a frame is built (see set_label_array).
+        :param max_label: If given, labels above it are replaced by free labels at loading. None keeps all labels.
+        :param compression: Compression of the saved TIF files: None, 'zlib' or 'zstd'.
+        :param prefetch: Number of time points prepared in the background ahead of the shown one. 0 disables it.
+        :param mesh_mode: How the surfaces are built, 'threshold' (one label at a time) or 'discrete' (all labels at once).
+            Ctrl + M switches between them.
+        :param mesh_threads: Number of threads building surfaces. None uses all cores, 1 builds them in the calling thread.
+        :param mesh_cache: Folder where the surfaces of whole frames are kept between sessions (see mesh_cache.py), by
+            default in the cache folder of the user. None to always mesh. python pyfix3d.py --warm-cache fills it ahead of time.
+        :param target_fps: Frame rate to keep while the camera moves, by showing decimated surfaces until it stops.
+            None always shows the full surfaces.
+        :param memory_budget: Megabytes the frames in memory may hold with their surfaces, None for no limit besides
+            cache_size. Over it, the surfaces of distant frames are freed first, then their raw data, then unedited frames.
+        :param render_mode: 'actors' draws every label with its own actor. 'lut' draws all labels of a frame as one mesh
+            colored by a lookup table, so recoloring only updates the table and a frame takes a few draw calls.
         """
         self.log("visualizer.py: init")
             
         self.t = 0
-        self.oversegmentations = []
-        self.raw = []
+        self.workers = workers
+        self.cache_size = cache_size
+        self.memmap = memmap
+        self.max_label = max_label
+        self.compression = compression
+        self.prefetch = prefetch
+        self.mesh_mode = mesh_mode
+        self.mesh_scheduler = MeshScheduler(mesh_threads)
+        self.mesh_cache = MeshCache(mesh_cache) if mesh_cache is not None else None
+        self.target_fps = target_fps
+        self.memory_budget = memory_budget
+        self.render_mode = render_mode
+        self.save_folder = None  # folder of the last save, only frames changed since are written to it again
         self.selected_labels = []
 
-        self.imageDataObjects = []
         self.modified = {}
 
         self.grayed_out = False
@@ -61,15 +102,18 @@ class Visualizer_3D:
         self.picker.SetTolerance(0.00001)
 
         self.labels_per_image = {}
+        self.label_pool = LabelPool(max_label, scan = lambda: self.frames.all_labels())
+        self.relabelled = {}  # t -> {old label: new label}, for the labels above max_label replaced at loading
 
-        self.marchingCubes = {}
+        # Actors are only created for labels which exist in the shown frame, and reused for other labels when
+        # they leave it, so there are never more than the labels of one frame
         self.surfaceMappers = {}
         self.surfaceActors = {}
+        self.shown_labels = set()
+        self.free_actors = []
+        self.label_positions = {}  # label -> position of its actor, for the labels moved by translate_actor
         self.highlightActors = []
-
-        self.visible = {}
-        for label in range(1, 256):
-            self.visible[label] = True
+        self.wireframe = False
 
         self.magic_wand = False
         self.destination_color = 0
@@ -77,8 +121,15 @@ class Visualizer_3D:
 
         self.draw_line_mode = False
 
+        # A chunk store is given as its folder, or like the TIF folders as a pattern inside it
+        self.store = None
+        for path in (folder, os.path.dirname(folder)):
+            if is_chunk_store(path):
+                self.store = ChunkStore(path)
+                break
+
         # Create a list of file paths for the TIF images
-        image_files = glob.glob(folder)  
+        image_files = glob.glob(folder) if self.store is None else []
         overseg_files = glob.glob(overseg_folder)
         raw_files = glob.glob(raw_folder)
 
@@ -86,7 +137,7 @@ class Visualizer_3D:
             overseg_files = image_files
 
         self.start_t = 0
-        self.end_t = len(image_files)
+        self.end_t = len(image_files) if self.store is None else len(self.store)
 
         self.init_colors_and_opacity()
         self.init_rendering()
@@ -129,10 +180,22 @@ class Visualizer_3D:
             
     ########################################################################################################
 
+    def log_statistics(self):
+        """ Logs how well the prefetching, the caches and the levels of detail did during the session. """
+        self.log(self.prefetcher.statistics())
+        if self.mesh_cache is not None:
+            self.log(self.mesh_cache.statistics())
+        self.log(self.lod_statistics())
+        self.log(self.frames.statistics())
+
+    ########################################################################################################
+
     def OnClose(self, window, event):
 
         self.log("visualizer.py: OnClose")
         if messagebox.askyesno("Confirm Exit", "Are you sure you want to close the application?"):
+            self.log_statistics()
+            self.frames.close()
             self.renderWindow.Finalize()  # Properly release the VTK render window resources
             self.renderWindowInteractor.TerminateApp()
             quit()
@@ -180,6 +243,11 @@ class Visualizer_3D:
         self.rawVolume.SetMapper(self.rawVolumeMapper)
         self.rawVolume.SetProperty(volumeProperty)
 
+        # The raw images are (x, y, z) for VTK, the labels (z, y, x)
+        swap = vtk.vtkMatrix4x4()
+        swap.DeepCopy((0, 0, 1, 0,  0, 1, 0, 0,  1, 0, 0, 0,  0, 0, 0, 1))
+        self.rawVolume.SetUserMatrix(swap)
+
         # Add the volume to the renderer
         self.renderer.AddViewProp(self.rawVolume)           
         
@@ -271,14 +339,16 @@ class Visualizer_3D:
         image_files.sort()
         overseg_files.sort()
 
+        if self.store is not None:
+            self.init_store_data(start, end, interval)
+            return
 
-        loaded = 0
-        # Load each image and add to imageDataObjects list
+        # Decide which files to load, and find the matching overseg and raw files
+        jobs = []
         for t, image_file in enumerate(image_files):
 
-            if t % interval != 0:
+            if not self.keep_time_point(t, len(image_files), start, end, interval):
                 continue
-            print(image_file)
 
             last_forward = image_file.rfind('/')
             last_backward = image_file.rfind('\\')  # Note the escape character for backslash
@@ -287,79 +357,81 @@ class Visualizer_3D:
 
             #number = int(self.longest_digit_substring(substring))
             
-            if (t < start and start >= 0) or (t > end and end > 0):
-                continue
+            self.filenames.append(image_file)
 
-            if (start < 0 and t < len(image_files)+start) or (end <= 0 and t > len(image_files)+end):
-                continue
+            # Ensure the names of the overseg files match the segmentationn files
+            matching_overseg = None
+            for item in overseg_files:
             
-            self.filenames.append(image_file)
-            real_img = imread(image_file)
+                if substring_img in item:
+                    matching_overseg = item
+                    break
 
-            current_labels = list(np.unique(real_img))
-            current_labels.remove(0)
+            raw_file = None
+            if len(raw_files) > 0:
+                raw_file = raw_files[len(jobs)]
 
-            # Make sure no labels >= 255
-            for label in current_labels:
-                if label >= 255:
-                    new_label = self.find_available_label()
-                    real_img[real_img == label] = new_label
-                    
-            current_labels = list(np.unique(real_img))
-            current_labels.remove(0) 
+            jobs.append((image_file, matching_overseg, raw_file, self.memmap))
 
-                
-            self.labels_per_image[loaded] = current_labels
+        # Frames are decoded when they are first shown, and only cache_size of them are kept in memory
+        self.frames = FrameStore(jobs, self.build_frame, self.get_frame_label_array, self.cache_size, self.workers,
+                                 build_raw = self.build_raw, memory_budget = self.memory_budget_bytes())
+        self.init_frame_views()
 
-            scalars_transposed = real_img.transpose(2, 1, 0)
-            scalars_fortran_order = np.asfortranarray(scalars_transposed)
-            vtk_scalars = numpy_to_vtk(num_array = scalars_fortran_order.ravel(), deep = True, array_type=vtk.VTK_FLOAT)
+    ########################################################################################################
 
-            self.imageData = vtk.vtkImageData()
-            self.imageData.SetDimensions(real_img.shape)
-            self.imageData.GetPointData().SetScalars(vtk_scalars)
-            self.imageData.SetSpacing(self.spacing_z, self.spacing_y, self.spacing_x)  # Customize spacing if needed
+    def keep_time_point(self, t, count, start, end, interval):
+        """ Whether time point t of count is loaded. Negative start and end count from the last time point. """
 
-            self.imageDataObjects.append(self.imageData)
+        if t % interval != 0:
+            return False
 
-            # Ensure the names of the overseg files match the segmentationn files
+        if (t < start and start >= 0) or (t > end and end > 0):
+            return False
 
-            matching_overseg = None
-            for item in overseg_files:
-            
-                if substring_img in item:
-                    matching_overseg = item
-                    break
-            
-            
-            if matching_overseg is not None:
+        if (start < 0 and t < count+start) or (end <= 0 and t > count+end):
+            return False
 
-                overseg = imread(matching_overseg)
-            else:
-                overseg = np.copy(real_img)
-                
-            overseg = self.split_overseg_labels_spanning_several_real(real_img, overseg)
-            self.oversegmentations.append(overseg)
+        return True
 
-            self.init_surfaces(current_labels, loaded)
-            self.init_surface_mappers()
+    ########################################################################################################
 
-            if len(raw_files) > 0:
-                raw_img = imread(raw_files[loaded])
-                scalars_transposed = raw_img.transpose(2, 1, 0)
-                scalars_fortran_order = np.asfortranarray(scalars_transposed)
-                vtk_scalars = numpy_to_vtk(num_array = scalars_fortran_order.ravel(), deep = True, array_type=vtk.VTK_FLOAT)
+    def init_store_data(self, start, end, interval):
+        """ Like init_image_data, for a time series in a chunk store. Frames are read chunk by chunk. """
+
+        self.store_time_points = [t for t in range(len(self.store)) if self.keep_time_point(t, len(self.store), start, end, interval)]
+
+        raw = "raw" if self.store.has("raw") else None
+        jobs = [(self.store.path, t, raw) for t in self.store_time_points]
+
+        self.frames = FrameStore(jobs, self.build_frame, self.get_frame_label_array, self.cache_size, self.workers,
+                                 load_store_frame, load_store_raw, self.build_raw, self.memory_budget_bytes(), load_store_labels)
+        self.init_frame_views()
+
+    ########################################################################################################
+
+    def memory_budget_bytes(self):
+        return None if self.memory_budget is None else int(self.memory_budget * 2**20)
+
+    ########################################################################################################
 
-                self.imageData = vtk.vtkImageData()
-                self.imageData.SetDimensions(raw_img.shape)
-                self.imageData.GetPointData().SetScalars(vtk_scalars)
-                self.imageData.SetSpacing(self.spacing_z, self.spacing_y, self.spacing_x)  # Customize spacing if needed
+    def init_frame_views(self):
 
-                self.raw.append(self.imageData)
+        self.imageDataObjects = FrameView(self.frames, "image_data")
+        self.oversegmentations = FrameView(self.frames, "overseg")
+        self.raw = FrameView(self.frames, "raw", available = self.frames.has_raw())
+        self.marchingCubes = FrameView(self.frames, "meshes")
 
-            loaded += 1
+        # While a time point is shown, its neighbours are loaded and meshed in the background
+        self.prefetcher = Prefetcher(self.frames, self.prefetch_meshes, self.prefetch)
 
-        self.end_t = loaded
+        # All frames have the same geometry; keep it without the scalars for picking and index computations
+        self.imageData = vtk.vtkImageData()
+        self.imageData.CopyStructure(self.imageDataObjects[self.t])
+
+        self.init_surface_mappers()
+
+        self.end_t = len(self.frames)
 
         """
         if len(self.imageDataObjects) > 0:
@@ -370,34 +442,413 @@ class Visualizer_3D:
         """
     ########################################################################################################
 
+    def build_frame(self, frame, decoded):
+        """
+        Fills a Frame of the frame store with the arrays decoded by the loader: converts the labels and the raw
+        data to vtkImageData. Called by the frame store whenever a time point is (re)loaded.
+        """
+        self.log("visualizer.py: build_frame")
+
+        t = frame.t
+        real_img = decoded["labels"]
+        current_labels = decoded["unique"]
+
+        # Make sure no labels > max_label, if there is a limit. Needs the labels of the previous frames, so it stays in this process.
+        real_img, current_labels, mapping = self.label_pool.relabel(real_img, current_labels)
+
+        if len(mapping) > 0:
+            self.relabelled[t] = mapping
+
+            # The new labels depend on the frames loaded before, so keep them instead of recomputing after eviction
+            frame.dirty = True
+            frame.save_box = tuple(slice(0, size) for size in real_img.shape)
+
+        # Only what the frame held when it was (re)loaded, the labels to mesh come from its counts (see present_labels)
+        self.labels_per_image[t] = current_labels
+
+        # Smallest integer type which holds the labels. Its largest value is reserved for selected voxels.
+        max_label = current_labels[-1] if len(current_labels) > 0 else 0
+        dtype = label_dtype(int(max_label) + 1)
+        self.ensure_label_capacity(max_label)
+
+        frame.image_data = vtk.vtkImageData()
+        frame.image_data.SetDimensions(real_img.shape)
+        frame.image_data.SetSpacing(self.spacing_z, self.spacing_y, self.spacing_x)  # Customize spacing if needed
+        self.set_label_array(frame, real_img, dtype)
+
+        # Counted once here, the edits keep the counts up to date (see count_labels)
+        frame.label_counts = LabelCounts(frame.labels, np.iinfo(frame.labels.dtype).max)
+
+        frame.overseg = decoded["overseg"]
+
+        self.build_raw(frame, decoded["raw"])
+
+    ########################################################################################################
+
+    def build_raw(self, frame, raw_img):
+        """ Converts the raw data of a frame to vtkImageData. Also called by the frame store after it freed the raw data. """
+
+        if raw_img is not None:
+            # The raw data keeps the type it has in the file. VTK uses the numpy buffer, which is kept alive by the frame.
+            # A (z, y, x) array in C order is a VTK image with the axes reversed, so a memory-mapped file is used as it is,
+            # and the raw volume swaps x and z back (see add_raw_data).
+            frame.raw_array = raw_img if raw_img.flags.c_contiguous else np.ascontiguousarray(raw_img)
+            vtk_scalars = numpy_to_vtk(num_array = frame.raw_array.reshape(-1), deep = False)
+
+            frame.raw = vtk.vtkImageData()
+            frame.raw.SetDimensions(raw_img.shape[::-1])
+            frame.raw.GetPointData().SetScalars(vtk_scalars)
+            frame.raw.SetSpacing(self.spacing_x, self.spacing_y, self.spacing_z)
+
+    ########################################################################################################
+
+    def set_label_array(self, frame, labels, dtype = None):
+        """
+        Makes the (z, y, x) labels the scalars of the frame's vtkImageData, without copying them if they are already
+        in Fortran order: the vtkImageData point i + j * nz + k * nz * ny is labels[i, j, k], so numpy and VTK see the
+        same buffer. frame.labels keeps the buffer alive, and writes into it only need a Modified() on the image data.
+        TIF stacks and store chunks are in C order, so labels read from them are always copied here, memory-mapped or not.
+        """
+        frame.labels = np.asfortranarray(labels, dtype = dtype)
+        if frame.label_voxels is not None:
+            frame.label_voxels.update(frame.labels)
+
+        vtk_scalars = numpy_to_vtk(num_array = frame.labels.ravel(order = 'F'), deep = False)
+
+        frame.image_data.GetPointData().SetScalars(vtk_scalars)
+        frame.image_data.Modified()
+
+    ########################################################################################################
+
+    def restore_label_array(self, t, labels):
+        """ Writes a copy of the labels of frame t (e.g. a backup) back into its shared buffer. """
+        frame = self.frames.get(t)
+
+        # Only the surfaces around the restored voxels have to be rebuilt
+        changed = frame.labels != labels
+        box = box_of_mask(changed)
+        frame.edit_box = union_box(frame.edit_box, box)
+        frame.save_box = union_box(frame.save_box, box)
+        frame.label_counts.write(frame.labels[changed], labels[changed])
+
+        if frame.labels.dtype == labels.dtype:
+            if frame.label_voxels is not None:
+                ids = np.flatnonzero(changed.reshape(-1, order = 'F'))
+                frame.label_voxels.moved(ids, labels.reshape(-1, order = 'F')[ids])
+
+            np.copyto(frame.labels, labels)
+            frame.image_data.Modified()
+        else:
+            # The frame was converted to a larger type since the copy was made
+            self.set_label_array(frame, labels, frame.labels.dtype)
+
+    ########################################################################################################
+
+    def get_frame_label_array(self, frame):
+        """ The labels of a Frame as a (z, y, x) numpy array, used by the frame store to spill edited frames. """
+        return frame.labels
+
+    ########################################################################################################
+
+    def get_extents(self, t):
+        """
+        The bounding boxes of the labels of frame t, computed in one pass the first time they are needed. Writes
+        only grow them (see grow_extent), so a box may be larger than its label but always contains it.
+        """
+        frame = self.frames.get(t)
+
+        if frame.extents is None:
+            # The selection value is left out, it is the largest value of the type
+            present = frame.label_counts.present()
+            max_label = int(present[-1]) if len(present) > 0 else 0
+
+            frame.extents = label_extents(frame.labels, max_label)
+
+        return frame.extents
+
+    ########################################################################################################
+
+    def get_chunk_index(self, t):
+        """ The ChunkIndex of the oversegmentation of frame t, built the first time it is needed and then kept up to date. """
+        frame = self.frames.get(t)
+
+        if frame.chunk_index is None:
+            frame.chunk_index = ChunkIndex(frame.overseg)
+
+        return frame.chunk_index
+
+    ########################################################################################################
+
+    def voxels_of_label(self, t, label):
+        """ The VTK point ids of the voxels of label in frame t, from its VoxelIndex. """
+        frame = self.frames.get(t)
+
+        if frame.label_voxels is None:
+            frame.label_voxels = VoxelIndex(frame.labels)
+
+        return frame.label_voxels.voxels(label)
+
+    def voxels_of_chunk(self, t, chunk):
+        """ The VTK point ids of the voxels of an oversegmentation chunk of frame t. """
+        frame = self.frames.get(t)
+
+        if frame.chunk_voxels is None:
+            frame.chunk_voxels = VoxelIndex(frame.overseg)
+
+        return frame.chunk_voxels.voxels(chunk)
+
+    ########################################################################################################
+
+    def grow_extent(self, t, label, box):
+        """ Called after label was written into the voxels of frame t inside box. """
+        if box is None:
+            return
+
+        # The surfaces are rebuilt around the written voxels only (see submit_surfaces), and saved by their chunks only
+        frame = self.frames.get(t)
+        frame.edit_box = union_box(frame.edit_box, box)
+        frame.save_box = union_box(frame.save_box, box)
+
+        # If they weren't computed yet (e.g. the surfaces came from the mesh cache), they are now. They leave out the
+        # selection value, which is added here like any other label.
+        extents = self.get_extents(t)
+
+        label = int(label)
+        extents[label] = union_box(extents.get(label), box)
+
+    ########################################################################################################
+
+    def grow_extent_by_ids(self, t, label, point_ids):
+        """ Like grow_extent, for the VTK point ids of the written voxels. """
+        if len(point_ids) == 0:
+            return
+
+        dims = self.imageDataObjects[t].GetDimensions()
+        points = np.column_stack(np.unravel_index(np.asarray(point_ids, dtype = np.int64), dims, order = 'F'))
+        self.grow_extent(t, label, box_of_points(points))
+
+    ########################################################################################################
+
+    def write_labels(self, t, where, label, condition = None):
+        """
+        Writes label into voxels of frame t, in place in the buffer shared with the vtkImageData, and keeps the label
+        counts and extents up to date. The frame isn't marked dirty, as selections are written this way too.
+        :param where: A boolean (z, y, x) mask, or VTK point ids (flat indices in Fortran order).
+        :param condition: If given, called with the current values of those voxels, returns which of them to write.
+        :return: The point ids which were written and their previous values.
+        """
+        labels = self.get_numpy_array(t)
+        flat = labels.reshape(-1, order = 'F')  # a view, the labels are in Fortran order
+
+        where = np.asarray(where)
+        if where.dtype == bool:
+            ids = np.flatnonzero(where.reshape(-1, order = 'F'))
+        else:
+            ids = where.astype(np.int64).ravel()
+            ids = ids[(ids >= 0) & (ids < flat.size)]
+
+        old_values = flat[ids]
+        if condition is not None:
+            keep = condition(old_values)
+            ids = ids[keep]
+            old_values = old_values[keep]
+
+        if len(ids) == 0:
+            return ids, old_values
+
+        flat[ids] = label
+
+        frame = self.frames.get(t)
+        if frame.label_voxels is not None:
+            frame.label_voxels.moved(ids, label)
+
+        self.count_labels(t, old_values, label)
+        self.grow_extent_by_ids(t, label, ids)
+        self.imageDataObjects[t].Modified()
+
+        return ids, old_values
+
+    ########################################################################################################
+
+    def present_labels(self, t):
+        """ The labels frame t holds now, after all edits, without the background and the selection. """
+        return [int(label) for label in self.frames.get(t).label_counts.present()]
+
+    ########################################################################################################
+
+    def count_labels(self, t, old_values, new_values):
+        """ Called after voxels of frame t holding old_values were set to new_values (one value or one per voxel). """
+        self.frames.get(t).label_counts.write(old_values, new_values)
+
+    ########################################################################################################
+
+    def ensure_meshes(self, t, urgent = True):
+        """
+        Builds the surfaces of all labels of frame t, if they haven't been built since it was loaded. They are read
+        from the mesh cache if this frame was meshed before with the same labels and settings.
+        """
+        frame = self.frames.get(t)
+
+        if frame.meshes is not None:
+            return
+
+        # All surfaces are built at once, so there are no edits left to rebuild around
+        frame.edit_box = None
+
+        if self.mesh_cache is None:
+            frame.meshes = {}
+            self.init_surfaces(self.present_labels(t), t, urgent)
+            return
+
+        key = self.mesh_cache_key(frame)
+        meshes = self.mesh_cache.load(key)
+
+        if meshes is not None:
+            frame.meshes = meshes
+            self.submit_lods(frame, meshes)
+            self.frames.enforce_budget()
+            return
+
+        frame.meshes = {}
+        self.init_surfaces(self.present_labels(t), t, urgent)
+
+        if frame.meshes is not None:
+            self.mesh_cache.store(key, frame.meshes)
+
+    ########################################################################################################
+
+    def mesh_cache_key(self, frame):
+        return self.mesh_cache.key(frame.labels, frame.image_data.GetSpacing(), self.mesh_mode)
+
+    ########################################################################################################
+
+    def update_mesh_cache(self, time_points):
+        """
+        Called after frames were saved: their surfaces are already up to date with the edits, so they are stored under
+        the key of the saved labels and the next session doesn't mesh them again. Frames not in memory are left out.
+        """
+        if self.mesh_cache is None:
+            return
+
+        for t in time_points:
+            if not self.frames.is_loaded(t):
+                continue
+
+            frame = self.frames.get(t)
+            if frame.meshes is None:
+                continue
+
+            # The selected voxels aren't part of the saved labels
+            selection = self.selection_label(t)
+            meshes = {label: mesh for label, mesh in frame.meshes.items() if label != selection}
+
+            self.mesh_cache.store(self.mesh_cache_key(frame), meshes)
+
+    ########################################################################################################
+
+    def prefetch_meshes(self, t):
+        """ Called by the prefetcher's thread. Its meshing waits for the meshing of corrections. """
+        self.ensure_meshes(t, urgent = False)
+
+    ########################################################################################################
+
     def init_colors_and_opacity(self):
         """
-        Initializes the color and opacity transfer functions for the volume visualization. This sets up how the scalar
-        values in the data are mapped to colors and opacities in the rendered volume.
+        Initializes the per-label state: color, opacity and visibility are kept in arrays indexed by the label,
+        which grow when larger labels are loaded.
         """
         self.log("visualizer.py: init_colors_and_opacity")
-        
-        # Assuming the scalar range is from 0 to 255, adjust if it's different
-        max_label = 255
 
-        # Create a color transfer function
-        self.colorTransferFunction = vtk.vtkColorTransferFunction()
-        self.opacityTransferFunction = vtk.vtkPiecewiseFunction()
+        self.label_colors = np.zeros((0, 3))
+        self.label_opacity = np.zeros(0)
+        self.visible = np.zeros(0, dtype = bool)
 
-        # Set minimum scalar to black
-        self.colorTransferFunction.AddRGBPoint(0, 0.0, 0.0, 0.0)
+        self.ensure_label_capacity(255)
 
-        self.opacityTransferFunction.AddPoint(0, 0.0)  # Fully transparent at the minimum scalar
+    ########################################################################################################
 
-        for obj in range(1, max_label):
-            color = list(np.random.choice(np.arange(0, 1, 0.1), size = 3))
-            self.colorTransferFunction.AddRGBPoint(obj, color[0], color[1], color[2])
-            self.opacityTransferFunction.AddPoint(obj, 1.0)
-        self.colorTransferFunction.AddRGBPoint(max_label, 1.0, 1.0, 0.0)  # Yellow for value 255
-        self.opacityTransferFunction.AddPoint(max_label, 1.0)  # Fully opaque for value 255
+    def ensure_label_capacity(self, max_label):
+        """ Grows the per-label arrays so that they can be indexed with max_label. New labels get random colors. """
+
+        max_label = int(max_label)
+        old_size = len(self.visible)
+
+        if max_label < old_size:
+            return
+
+        new_size = max(max_label + 1, 2 * old_size)
+        new_colors = np.random.choice(np.arange(0, 1, 0.1), size = (new_size - old_size, 3))
+
+        self.label_colors = np.concatenate([self.label_colors, new_colors])
+        self.label_opacity = np.concatenate([self.label_opacity, np.ones(new_size - old_size)])
+        self.visible = np.concatenate([self.visible, np.ones(new_size - old_size, dtype = bool)])
+
+    ########################################################################################################
+
+    def get_label_color(self, label):
+        self.ensure_label_capacity(label)
+        return tuple(float(c) for c in self.label_colors[int(label)])
+
+    ########################################################################################################
+
+    def set_label_color(self, label, color):
+        self.ensure_label_capacity(label)
+        self.label_colors[int(label)] = color
+
+        if label in self.surfaceActors.keys():
+            self.surfaceActors[label].GetProperty().SetColor(self.get_label_color(label))
+        elif self.render_mode == "lut":
+            self.update_label_table()
+
+    ########################################################################################################
+
+    def is_label_visible(self, label):
+        self.ensure_label_capacity(label)
+        return bool(self.visible[int(label)])
+
+    def are_labels_visible(self, labels):
+        """ is_label_visible for an array of labels. """
+        labels = np.asarray(labels, dtype = np.int64)
+        if len(labels) > 0:
+            self.ensure_label_capacity(labels.max())
+        return self.visible[labels]
 
-        # Save the original opacity function to revert back to after graying out certain objects
-        self.opacityTransferFunctionCopy = self.copy_opacity(self.opacityTransferFunction)
+    ########################################################################################################
+
+    def selection_label(self, t = None):
+        """ The value written into the labels of frame t to mark selected voxels: the largest value of its type. """
+        if t is None:
+            t = self.t
+        return np.iinfo(self.frames.get(t).labels.dtype).max
+
+    ########################################################################################################
+
+    def fit_label(self, t, label):
+        """
+        Makes sure label can be written into frame t: if it would reach the selection value, the labels of
+        the frame are converted to the next larger integer type.
+        """
+        # A label chosen by the user is used from now on, and mustn't be handed out as a new one
+        self.label_pool.add([label])
+
+        selection = self.selection_label(t)
+        if label < selection:
+            return
+
+        frame = self.frames.get(t)
+        labels = frame.labels
+        dtype = label_dtype(int(label) + 1)
+
+        new_labels = labels.astype(dtype, order = 'F')
+        new_labels[labels == selection] = np.iinfo(dtype).max
+        self.set_label_array(frame, new_labels)
+
+        if frame.extents is not None and selection in frame.extents:
+            frame.extents[int(np.iinfo(dtype).max)] = frame.extents.pop(selection)
+
+        frame.label_counts.selection = np.iinfo(dtype).max
+
+        self.ensure_label_capacity(label)
 
     ########################################################################################################
 
@@ -443,6 +894,16 @@ class Visualizer_3D:
 
         # Enable depth peeling in the renderer
         self.renderer.SetUseDepthPeeling(1)
+
+        # While the camera moves the interactor asks for target_fps, and coarser surfaces are shown (see on_render_start)
+        if self.target_fps is not None:
+            self.renderWindowInteractor.SetDesiredUpdateRate(self.target_fps)
+
+        self.lod_level = 0
+        self.camera_moving = False
+        self.full_render_time = 0.0
+        self.renderWindow.AddObserver("StartEvent", self.on_render_start)
+        self.renderWindow.AddObserver("EndEvent", self.on_render_end)
         
 
     ########################################################################################################
@@ -479,19 +940,50 @@ class Visualizer_3D:
 
         self.log("visualizer.py: create_highlight_actors")
 
-        # Getting the overlay mask based on the oversegmentation label
-        overlay_mask = np.copy(self.oversegmentations[self.t])
-        overlay_mask[overlay_mask != label] = 0
+        frame = self.frames.get(self.t)
+
+        # Built once per chunk, until the chunks of the frame change
+        if int(label) not in frame.highlights:
+            actor = self.build_highlight_actor(frame, label)
+            if actor is None:
+                return
+            frame.highlights[int(label)] = actor
+
+        actor = frame.highlights[int(label)]
+        if actor in self.highlightActors:
+            return
+
+        # Step 5: Add actor to renderer and keep track for easy removal
+        self.renderer.AddActor(actor)
+        self.highlightActors.append(actor)
+
+    ########################################################################################################
+
+    def build_highlight_actor(self, frame, label):
+        """ The actor of the surface of an oversegmentation chunk, None if the chunk is empty. """
+        overseg = frame.overseg
+
+        # Only the chunk's bounding box with one voxel around it is meshed
+        if frame.overseg_extents is None:
+            frame.overseg_extents = label_extents(overseg, int(overseg.max()))
+
+        box = frame.overseg_extents.get(int(label))
+        if box is None:
+            return None
+
+        box = tuple(slice(max(part.start - 1, 0), min(part.stop + 1, size)) for part, size in zip(box, overseg.shape))
+
+        # Getting the overlay mask based on the oversegmentation label, as 0/1 bytes
+        overlay_mask = (overseg[box] == label).astype(np.uint8)
 
         # Converting numpy array (1D) to VTK array
-        scalars_transposed = overlay_mask.transpose(2, 1, 0)
-        scalars_fortran_order = np.asfortranarray(scalars_transposed)
-        vtk_scalars = numpy_to_vtk(num_array=scalars_fortran_order.ravel(), deep = True, array_type=vtk.VTK_FLOAT)
+        vtk_scalars = numpy_to_vtk(num_array = np.asfortranarray(overlay_mask).ravel(order = 'F'), deep = True)
 
         mask_image = vtk.vtkImageData()
         mask_image.SetDimensions(overlay_mask.shape)
         mask_image.GetPointData().SetScalars(vtk_scalars)
         mask_image.SetSpacing(self.spacing_z, self.spacing_y, self.spacing_x)
+        mask_image.SetOrigin(box[0].start * self.spacing_z, box[1].start * self.spacing_y, box[2].start * self.spacing_x)
 
         # Step 3: Apply marching cubes to this mask to create geometry
         marchingCubes = vtk.vtkMarchingCubes()
@@ -519,9 +1011,7 @@ class Visualizer_3D:
         actor.GetProperty().SetSpecular(0.0)  # Increase the specular highlight (shininess)
         actor.GetProperty().SetSpecularPower(20)
 
-        # Step 5: Add actor to renderer and keep track for easy removal
-        self.renderer.AddActor(actor)
-        self.highlightActors.append(actor)
+        return actor
 
     ########################################################################################################
 
@@ -594,11 +1084,10 @@ class Visualizer_3D:
         self.log("visualizer.py: make_corrections")
 
         if self.backup is None:
-            self.backup = vtk.vtkImageData()
-            self.backup.DeepCopy(self.imageDataObjects[self.t])
+            self.backup = self.get_numpy_array(self.t).copy(order = 'F')
             
-        self.undo_copy = vtk.vtkImageData()
-        self.undo_copy.DeepCopy(self.backup)
+        # The backup isn't modified, only replaced, so it can be shared
+        self.undo_copy = self.backup
         self.last_correction_t = self.t
         
         if self.magic_wand:
@@ -623,8 +1112,8 @@ class Visualizer_3D:
         if self.t != self.last_correction_t or self.undo_copy is None:
             return
             
-        self.imageDataObjects[self.t].DeepCopy(self.undo_copy)
-        self.imageDataObjects[self.t].Modified()
+        self.restore_label_array(self.t, self.undo_copy)
+        self.frames.mark_dirty(self.t)
         self.init_surfaces(self.undo_labels, self.t)
         self.set_current_image(self.t)
         #self.init_surface_mappers()
@@ -708,7 +1197,7 @@ class Visualizer_3D:
         elif key == "a" or key == "A":
             self.show_all_labels()
             
-        elif key == "m" or key == "M":
+        elif (ctrl_pressed == False) and (key == "m" or key == "M"):
             self.mark_labels(self.selected_labels)
             self.show_unmarked()
 
@@ -759,6 +1248,9 @@ class Visualizer_3D:
         elif ctrl_pressed and (key == "z" or key == "Z"):
             self.undo()
 
+        elif ctrl_pressed and (key == "m" or key == "M"):
+            self.switch_mesh_mode()
+
         self.textActor.SetInput("Time: " + str(self.t) + "/" + str(len(self.imageDataObjects) - 1))
         self.renderer.GetRenderWindow().Render()
 
@@ -783,8 +1275,8 @@ class Visualizer_3D:
         self.interactorStyle = self.LineFit
         self.LineFit.load_existing_models()
         
-        for label in range(1, 256):
-            self.surfaceActors[label].GetProperty().SetRepresentationToWireframe()
+        self.wireframe = True
+        self.update_label_actors()
                     
         self.renderWindowInteractor.SetInteractorStyle(self.interactorStyle)
 
@@ -812,8 +1304,8 @@ class Visualizer_3D:
             #self.interactorStyle = CustomInteractorStyle(self)
             #self.renderWindowInteractor.SetInteractorStyle(self.interactorStyle)
 
-            for label in range(1, 256):
-                self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
+            self.wireframe = False
+            self.update_label_actors()
 
         self.renderer.GetRenderWindow().Render()
 
@@ -828,8 +1320,8 @@ class Visualizer_3D:
         self.interactorStyle = self.magic_wand_style
         self.renderWindowInteractor.SetInteractorStyle(self.interactorStyle)
 
-        for label in range(1, 256):
-            self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
+        self.wireframe = False
+        self.update_label_actors()
 
         self.magic_wand = True
         self.set_magic_wand_cursor()
@@ -851,7 +1343,7 @@ class Visualizer_3D:
             return
 
         self.destination_color = self.selected_labels[-1]
-        newColor = self.colorTransferFunction.GetColor(self.destination_color)
+        newColor = self.get_label_color(self.destination_color)
         self.destinationActor.GetTextProperty().SetColor(newColor)
         self.destinationActor.SetInput("destination set")
 
@@ -872,7 +1364,7 @@ class Visualizer_3D:
             return
 
         self.source_color = self.selected_labels[-1]
-        newColor = self.colorTransferFunction.GetColor(self.source_color)
+        newColor = self.get_label_color(self.source_color)
         self.sourceActor.GetTextProperty().SetColor(newColor)
         self.sourceActor.SetInput("source set")
 
@@ -889,11 +1381,11 @@ class Visualizer_3D:
         
         self.source_color , self.destination_color = self.destination_color , self.source_color
 
-        newDestinationColor = self.colorTransferFunction.GetColor(self.destination_color)
+        newDestinationColor = self.get_label_color(self.destination_color)
         self.destinationActor.GetTextProperty().SetColor(newDestinationColor)
         self.destinationActor.SetInput("destination set")
 
-        newSourceColor = self.colorTransferFunction.GetColor(self.source_color)
+        newSourceColor = self.get_label_color(self.source_color)
         self.sourceActor.GetTextProperty().SetColor(newSourceColor)
         self.sourceActor.SetInput("source set")
 
@@ -910,10 +1402,12 @@ class Visualizer_3D:
         
         self.grayed_out = True
         
-        for obj in range(1, 255):
-            if obj not in selected:
-                self.surfaceActors[obj].GetProperty().SetOpacity(0.03)
-                
+        self.label_opacity[:] = 0.03
+        for obj in selected:
+            self.ensure_label_capacity(obj)
+            self.label_opacity[int(obj)] = 1.0
+
+        self.update_label_actors()
         self.selected_labels = []
 
         self.renderer.GetRenderWindow().Render()
@@ -924,11 +1418,10 @@ class Visualizer_3D:
 
         self.log("visualizer.py: shades_of_gray")
         
-        for label in range(1, 255):            
-            color = 3 * list(np.random.choice(np.arange(0, 1, 0.1), size = 1))
-            self.colorTransferFunction.AddRGBPoint(label, color[0], color[1], color[2])
-            self.surfaceActors[label].GetProperty().SetColor(color)
-                
+        gray = np.random.choice(np.arange(0, 1, 0.1), size = len(self.label_colors))
+        self.label_colors[:] = gray[:, np.newaxis]
+
+        self.update_label_actors()
         self.selected_labels = []
 
         self.renderer.GetRenderWindow().Render()
@@ -945,8 +1438,7 @@ class Visualizer_3D:
 
         for label in selected:            
             color = list(np.random.choice(np.arange(0, 1, 0.1), size = 3))
-            self.colorTransferFunction.AddRGBPoint(label, color[0], color[1], color[2])
-            self.surfaceActors[label].GetProperty().SetColor(color)
+            self.set_label_color(label, color)
                 
         self.selected_labels = []
 
@@ -960,11 +1452,9 @@ class Visualizer_3D:
 
         self.clear_selection()
 
-        for label in range(1, 255):            
-            color = list(np.random.choice(np.arange(0, 1, 0.1), size = 3))
-            self.colorTransferFunction.AddRGBPoint(label, color[0], color[1], color[2])
-            self.surfaceActors[label].GetProperty().SetColor(color)
-                
+        self.label_colors[:] = np.random.choice(np.arange(0, 1, 0.1), size = self.label_colors.shape)
+
+        self.update_label_actors()
         self.selected_labels = []
 
         self.renderer.GetRenderWindow().Render()
@@ -976,8 +1466,8 @@ class Visualizer_3D:
         self.log("visualizer.py: show_grayed")
         self.clear_selection()
         self.grayed_out = False
-        for obj in range(1, 255):
-            self.surfaceActors[obj].GetProperty().SetOpacity(1.0)
+        self.label_opacity[:] = 1.0
+        self.update_label_actors()
 
         self.renderer.GetRenderWindow().Render()
 
@@ -997,75 +1487,398 @@ class Visualizer_3D:
 
     #############################################################################################################
 
-    def init_surfaces(self, unique_labels, t):
+    def init_surfaces(self, unique_labels, t, urgent = True):
 
         self.log("visualizer.py: init_surfaces")
 
-        if t not in self.marchingCubes.keys():
-            self.marchingCubes[t] = {}
+        self.gather_surfaces(self.submit_surfaces(unique_labels, t, urgent))
 
-        thresholdFilter = vtk.vtkImageThreshold()
-        thresholdFilter.SetInputData(self.imageDataObjects[t])
-      
-        for label in unique_labels:
-            # Threshold the volume data to create a binary mask for the current label
-            
-            thresholdFilter.ThresholdBetween(label, label)
-            thresholdFilter.SetInValue(1)
-            thresholdFilter.SetOutValue(0)
-            thresholdFilter.Update()
-
-            # Apply Marching Cubes on the binary mask to generate vtkPolyData
-            marchingCubes = vtk.vtkFlyingEdges3D() #vtk.vtkMarchingCubes()
-            marchingCubes.SetInputData(thresholdFilter.GetOutput())
-            marchingCubes.SetValue(0, 0.5)  # Generate surface for the thresholded value
-            marchingCubes.Update()
-            """
-            # Now apply Quadric Decimation on the resulting vtkPolyData
-            decimator = vtk.vtkQuadricDecimation()
-            decimator.SetInputData(marchingCubes.GetOutput())
-            decimator.SetTargetReduction(0.2)  # Target 20% reduction
-            decimator.Update()
-            """
-            # Store the decimated output instead of the original marching cubes output
-            self.marchingCubes[t][label] = marchingCubes.GetOutput()#decimator.GetOutput()
-
-            #memory_usage_kb = decimator.GetOutput().GetActualMemorySize()
-            #print(f"Memory usage: {memory_usage_kb} KB")
-        
+    #############################################################################################################
+
+    def submit_surfaces(self, unique_labels, t, urgent = True):
+        """
+        Starts building the surfaces of the labels of frame t on the mesh threads. gather_surfaces waits for them and
+        stores them in marchingCubes[t], so several frames can be meshed at the same time.
+        :param urgent: False for background work, which lets the meshing of corrections go first.
+        """
+        frame = self.frames.get(t)
+
+        # Surfaces of frames which were never shown are built all at once in ensure_meshes
+        if frame.meshes is None:
+            return None
+
+        # Labels without a box aren't in the frame. The selected voxels have one once something was selected.
+        extents = self.get_extents(t)
+        boxes = {label: extents[int(label)] for label in unique_labels if int(label) in extents}
+
+        edit_box, frame.edit_box = frame.edit_box, None
+        labels = set(int(label) for label in unique_labels)
+
+        # The blocks of other labels around the edit would be out of date, they are split into blocks again when needed
+        if edit_box is not None:
+            for label in list(frame.blocks.keys()):
+                if label not in labels and boxes_overlap(extents.get(label, edit_box), edit_box):
+                    del frame.blocks[label]
+
+        # After an edit the threshold mode only rebuilds the blocks of the surfaces around it
+        if edit_box is not None and self.mesh_mode == "threshold":
+            dims = frame.image_data.GetDimensions()
+            edited = block_indices(edit_box, dims)
+
+            blocks = {}
+            for label in sorted(labels):
+                if label not in extents:
+                    blocks[label] = list(frame.blocks.get(label, {}).keys())  # the label is gone
+                elif label not in frame.blocks:
+                    blocks[label] = block_indices(extents[label], dims)  # first edit of the label
+                else:
+                    blocks[label] = [index for index in edited
+                                     if index in frame.blocks[label] or boxes_overlap(block_box(index, dims), extents[label])]
+
+            jobs = self.mesh_scheduler.submit_blocks(frame.image_data, blocks, urgent)
+            return frame, jobs, time.time(), True
+
+        for label in labels:
+            frame.blocks.pop(label, None)
+
+        jobs = self.mesh_scheduler.submit(frame.image_data, unique_labels, self.mesh_mode, boxes, urgent)
+        return frame, jobs, time.time(), False
 
     #############################################################################################################
 
-    def init_surface_mappers(self):
+    def gather_surfaces(self, submitted):
+
+        if submitted is None:
+            return
+
+        frame, jobs, start_time, by_blocks = submitted
+        meshes = self.mesh_scheduler.gather(jobs)
+
+        # Freed in the meantime to stay within the memory budget, they are built again when the frame is shown
+        if frame.meshes is None:
+            return
+
+        blocks = 0
+        if by_blocks:
+            for label, rebuilt in meshes.items():
+                blocks += len(rebuilt)
+
+                # Empty blocks are dropped, so only the blocks with a part of the surface are kept
+                merged = dict(frame.blocks.get(label, {}))
+                merged.update(rebuilt)
+                frame.blocks[label] = {index: mesh for index, mesh in merged.items() if mesh.GetNumberOfCells() > 0}
+
+                meshes[label] = append_meshes(frame.blocks[label].values())
+
+        # The frame object itself is updated, in case it was evicted in the meantime
+        frame.meshes.update(meshes)
+
+        for label in meshes.keys():
+            frame.lods.pop(label, None)
+        self.submit_lods(frame, meshes)
+
+        mode = f"{self.mesh_mode}, {blocks} blocks" if by_blocks else self.mesh_mode
+        print(f"Meshed {len(meshes)} labels of time point {frame.t} in {time.time() - start_time:.3f} s ({mode})")
+
+        self.frames.enforce_budget()
+
+    #############################################################################################################
+
+    def submit_lods(self, frame, meshes):
+        """ Starts building the levels of detail of the large surfaces of meshes in the background (see on_render_start). """
+        if self.target_fps is None:
+            return
+
+        meshes = {label: mesh for label, mesh in meshes.items() if mesh.GetNumberOfCells() >= LOD_MIN_TRIANGLES}
+
+        for future in self.mesh_scheduler.submit_decimation(meshes):
+            future.add_done_callback(lambda future: self.store_lods(frame, meshes, future))
+
+    #############################################################################################################
+
+    def store_lods(self, frame, meshes, future):
+        """ Called on a mesh thread. Levels of surfaces which were rebuilt in the meantime are dropped. """
+        if future.exception() is not None:
+            return
+
+        for label, levels in future.result().items():
+            if frame.meshes is not None and frame.meshes.get(label) is meshes[label]:
+                frame.lods[label] = levels
+
+    #############################################################################################################
+
+    def lod_mesh(self, frame, label, level):
+        """ The surface of label at a level of detail, 0 being the full one. Falls back to it until the levels are built. """
+        if level == 0 or label not in frame.lods:
+            return frame.meshes[label]
+
+        return frame.lods[label][level - 1]
+
+    #############################################################################################################
+
+    def lod_triangles(self):
+        """ The number of triangles of the visible surfaces at every level of detail, the full one first. """
+        frame = self.frames.get(self.t)
+        labels = [label for label in self.shown_labels if self.is_label_visible(label)]
+
+        return [sum(self.lod_mesh(frame, label, level).GetNumberOfCells() for label in labels)
+                for level in range(len(LOD_REDUCTIONS) + 1)]
+
+    #############################################################################################################
 
+    def choose_lod_level(self):
+        """ The finest level of detail whose triangles can be drawn at target_fps, judging by the last full render. """
+        if self.full_render_time <= 1.0 / self.target_fps:
+            return 0
+
+        triangles = self.lod_triangles()
+        budget = triangles[0] / (self.full_render_time * self.target_fps)
+
+        for level, count in enumerate(triangles):
+            if count <= budget:
+                return level
+
+        return len(triangles) - 1
+
+    #############################################################################################################
+
+    def show_lod_level(self, level):
+
+        self.lod_level = level
+
+        if self.render_mode == "lut":
+            self.show_combined_labels(self.combined_visible or (), level)
+            return
+
+        frame = self.frames.get(self.t)
+        for label in self.shown_labels:
+            self.surfaceMappers[label].SetInputData(self.lod_mesh(frame, label, level))
+
+    #############################################################################################################
+
+    def on_render_start(self, obj, event):
+        """
+        The interaction styles raise the desired update rate of the render window while the camera moves, and set
+        it back to the still rate when it stops. Coarse surfaces are shown in between.
+        """
+        if self.target_fps is None:
+            return
+
+        moving = self.renderWindow.GetDesiredUpdateRate() > self.renderWindowInteractor.GetStillUpdateRate()
+
+        if moving and not self.camera_moving:
+            self.camera_moving = True
+            level = self.choose_lod_level()
+            if level != self.lod_level:
+                self.show_lod_level(level)
+
+        elif not moving and self.camera_moving:
+            self.camera_moving = False
+            if self.lod_level != 0:
+                self.show_lod_level(0)
+
+    #############################################################################################################
+
+    def on_render_end(self, obj, event):
+        if not self.camera_moving:
+            self.full_render_time = self.renderer.GetLastRenderTimeInSeconds()
+
+    #############################################################################################################
+
+    def lod_statistics(self):
+        triangles = ", ".join(f"level {level}: {count}" for level, count in enumerate(self.lod_triangles()))
+        return f"triangles of time point {self.t} ({triangles}), last full render {self.full_render_time:.3f} s"
+
+    #############################################################################################################
+
+    def switch_mesh_mode(self):
+        """ Switches to the next mesh mode and rebuilds the surfaces of the current time point with it. """
+
+        self.log("visualizer.py: switch_mesh_mode")
+
+        self.clear_selection()
+        self.mesh_mode = MESH_MODES[(MESH_MODES.index(self.mesh_mode) + 1) % len(MESH_MODES)]
+
+        self.init_surfaces(self.present_labels(self.t), self.t)
+        self.set_current_image(self.t)
+
+    #############################################################################################################
+
+    def init_surface_mappers(self):
+        """
+        Creates the actor which shows the selected voxels. The actors of the labels are created by
+        get_surface_actor, the first time a label is shown.
+        """
         self.log("visualizer.py: init_surface_mappers")
 
-        for label in range(1, 256):
-            self.surfaceMappers[label] = vtk.vtkPolyDataMapper()
-            self.surfaceMappers[label].ScalarVisibilityOff()
+        self.selectionMapper = vtk.vtkPolyDataMapper()
+        self.selectionMapper.ScalarVisibilityOff()
+
+        self.selectionActor = vtk.vtkActor()
+        self.selectionActor.SetMapper(self.selectionMapper)
+        self.selectionActor.GetProperty().SetColor(1.0, 1.0, 0.0)  # Yellow for the selection
+        self.selectionActor.GetProperty().SetInterpolationToPhong()
+        self.selectionActor.GetProperty().SetAmbient(0.9)
+        self.selectionActor.GetProperty().SetDiffuse(0.2)
+        self.selectionActor.GetProperty().SetSpecular(0.1)
+        self.selectionActor.GetProperty().SetSpecularPower(2)
+        self.selectionActor.VisibilityOff()
+
+        self.renderer.AddActor(self.selectionActor)
+
+        # For the 'lut' render mode: the visible labels of the frame in one mesh, colored by the label of each triangle
+        self.label_table = vtk.vtkLookupTable()
+
+        self.labelsMapper = vtk.vtkPolyDataMapper()
+        self.labelsMapper.SetScalarModeToUseCellFieldData()
+        self.labelsMapper.SelectColorArray("Label")
+        self.labelsMapper.SetColorModeToMapScalars()
+        self.labelsMapper.SetLookupTable(self.label_table)
+        self.labelsMapper.UseLookupTableScalarRangeOn()
+        self.labelsMapper.ScalarVisibilityOn()
+
+        self.labelsActor = vtk.vtkActor()
+        self.labelsActor.SetMapper(self.labelsMapper)
+        self.labelsActor.GetProperty().SetInterpolationToPhong()
+        self.labelsActor.GetProperty().SetAmbient(0.9)
+        self.labelsActor.GetProperty().SetDiffuse(0.2)
+        self.labelsActor.GetProperty().SetSpecular(0.1)
+        self.labelsActor.GetProperty().SetSpecularPower(2)
+        self.labelsActor.SetVisibility(self.render_mode == "lut")
+
+        self.renderer.AddActor(self.labelsActor)
+        self.combined_visible = None  # the labels in the mesh of labelsActor
 
-            self.surfaceActors[label] = vtk.vtkActor()
-            self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
-            
-            # Retrieve and apply the color for this label
-            color = self.colorTransferFunction.GetColor(label)
-            self.surfaceActors[label].GetProperty().SetColor(color)  # Set the color
-            self.surfaceActors[label].GetProperty().SetOpacity(1.0)
-            self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
-            self.surfaceActors[label].SetMapper(self.surfaceMappers[label])
-            self.surfaceActors[label].GetProperty().SetInterpolationToPhong()
+    #############################################################################################################
 
-            self.surfaceActors[label].GetProperty().SetAmbient(0.9)  # Increase the ambient light component
-            self.surfaceActors[label].GetProperty().SetDiffuse(0.2)
-            self.surfaceActors[label].GetProperty().SetSpecular(0.1)  # Increase the specular highlight (shininess)
-            self.surfaceActors[label].GetProperty().SetSpecularPower(2)
+    def get_surface_actor(self, label):
+        """ Returns the actor of a label, taking a free one or creating it and its mapper if the label isn't shown yet. """
 
-            # Add the actor to the renderer
-            self.renderer.AddActor(self.surfaceActors[label])
+        if label in self.surfaceActors.keys():
+            return self.surfaceActors[label]
 
-            #print ("Memory of mappers: ", sys.getsizeof(self.surfaceMappers[label]))
-            #print ("Memory of actors: ", sys.getsizeof(self.surfaceActors[label]))
+        if len(self.free_actors) > 0:
+            self.surfaceMappers[label], self.surfaceActors[label] = self.free_actors.pop()
+            self.surfaceActors[label].GetProperty().SetColor(self.get_label_color(label))
+            self.surfaceActors[label].GetProperty().SetOpacity(self.label_opacity[int(label)])
+            if self.wireframe:
+                self.surfaceActors[label].GetProperty().SetRepresentationToWireframe()
+            else:
+                self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
+            self.surfaceActors[label].SetPosition(self.label_positions.get(int(label), (0, 0, 0)))
+            return self.surfaceActors[label]
+
+        self.surfaceMappers[label] = vtk.vtkPolyDataMapper()
+        self.surfaceMappers[label].ScalarVisibilityOff()
+
+        self.surfaceActors[label] = vtk.vtkActor()
+        self.surfaceActors[label].GetProperty().SetRepresentationToSurface()
         
+        # Retrieve and apply the color for this label
+        color = self.get_label_color(label)
+        self.surfaceActors[label].GetProperty().SetColor(color)  # Set the color
+        self.surfaceActors[label].GetProperty().SetOpacity(self.label_opacity[int(label)])
+        self.surfaceActors[label].SetMapper(self.surfaceMappers[label])
+        self.surfaceActors[label].SetPosition(self.label_positions.get(int(label), (0, 0, 0)))
+        self.surfaceActors[label].GetProperty().SetInterpolationToPhong()
+
+        self.surfaceActors[label].GetProperty().SetAmbient(0.9)  # Increase the ambient light component
+        self.surfaceActors[label].GetProperty().SetDiffuse(0.2)
+        self.surfaceActors[label].GetProperty().SetSpecular(0.1)  # Increase the specular highlight (shininess)
+        self.surfaceActors[label].GetProperty().SetSpecularPower(2)
+        self.surfaceActors[label].VisibilityOff()
+
+        # Add the actor to the renderer
+        self.renderer.AddActor(self.surfaceActors[label])
+
+        return self.surfaceActors[label]
+
+    #############################################################################################################
+
+    def release_surface_actor(self, label):
+        """
+        Hides the actor of a label which isn't in the shown frame any more and keeps it for another label.
+        Its position stays in label_positions, for when the label is shown again.
+        """
+
+        mapper = self.surfaceMappers.pop(label)
+        actor = self.surfaceActors.pop(label)
+
+        actor.VisibilityOff()
+        actor.SetPickable(0)
+        actor.SetPosition(0, 0, 0)
+        mapper.RemoveAllInputConnections(0)  # the surface can be freed with its frame
+
+        self.free_actors.append((mapper, actor))
+
+    #############################################################################################################
+
+    def update_label_actors(self):
+        """ Applies the per-label color, opacity and visibility, and the representation, to the shown actors. """
+
+        if self.render_mode == "lut":
+            self.update_label_table()
+            return
+
+        for label in self.shown_labels:
+            actor = self.surfaceActors[label]
+            visible = self.is_label_visible(label)
+
+            actor.GetProperty().SetColor(self.get_label_color(label))
+            actor.GetProperty().SetOpacity(self.label_opacity[int(label)])
+            actor.SetVisibility(visible)
+            actor.SetPickable(visible)
+
+            if self.wireframe:
+                actor.GetProperty().SetRepresentationToWireframe()
+            else:
+                actor.GetProperty().SetRepresentationToSurface()
+
+    #############################################################################################################
+
+    def update_label_table(self):
+        """
+        The 'lut' render mode: colors and opacities go into the lookup table, label i is entry i. Hidden labels are
+        left out of the mesh instead, so that they can't be picked and don't make the whole mesh translucent.
+        """
+        size = len(self.label_colors)
+
+        table = np.empty((size, 4), dtype = np.uint8)
+        table[:, :3] = np.round(np.clip(self.label_colors, 0, 1) * 255)
+        table[:, 3] = np.round(np.clip(self.label_opacity, 0, 1) * 255)
+
+        # SetTable marks the values as set by hand, so the mapper doesn't build a default table over them
+        self.label_table.SetTable(numpy_to_vtk(table, deep = True))
+        self.label_table.SetTableRange(-0.5, size - 0.5)
+
+        visible = frozenset(label for label in self.shown_labels if self.is_label_visible(label))
+        if visible != self.combined_visible:
+            self.show_combined_labels(visible, self.lod_level)
+
+        if self.wireframe:
+            self.labelsActor.GetProperty().SetRepresentationToWireframe()
+        else:
+            self.labelsActor.GetProperty().SetRepresentationToSurface()
+
+    #############################################################################################################
+
+    def show_combined_labels(self, labels, level = 0):
+        """ Puts the surfaces of labels at a level of detail into the single mesh of the 'lut' render mode. """
+        frame = self.frames.get(self.t)
+        labels = sorted(labels)
+        meshes = [self.lod_mesh(frame, label, level) for label in labels]
+        offsets = {label: self.label_positions[label] for label in labels if label in self.label_positions}
+
+        # Kept per frame and level, so switching frames and moving the camera only combine them again after a change
+        cached = frame.combined.get(level)
+        if (cached is None or cached[0] != labels or cached[2] != offsets
+                or any(mesh is not old for mesh, old in zip(meshes, cached[1]))):
+            cached = (labels, meshes, offsets, combine_meshes(list(zip(labels, meshes)), offsets))
+            frame.combined[level] = cached
+
+        self.labelsMapper.SetInputData(cached[3])
+        self.combined_visible = frozenset(labels)
+
     #############################################################################################################
 
     def set_current_image(self, image_index):
@@ -1073,24 +1886,37 @@ class Visualizer_3D:
         self.log("visualizer.py: set_current_image")
 
         # Method to set the current image index and update the display
-        currentImageData = self.imageDataObjects[self.t]
-        
-        # Extract all unique scalar values (labels) in the volume, excluding the background (assumed to be 0)
-        scalars = vtk_to_numpy(currentImageData.GetPointData().GetScalars())
-        unique_labels = np.unique(scalars)
-        unique_labels = unique_labels[unique_labels != 0]  # Exclude the background
+        self.prefetcher.show(self.t)
+        self.ensure_meshes(self.t)
+        meshes = self.marchingCubes[self.t]
+        selection = self.selection_label(self.t)
+        label_counts = self.frames.get(self.t).label_counts
 
-        for label in range(1, 256):
-            if label in unique_labels and label in self.marchingCubes[self.t].keys():
+        # Only the labels of this frame are visited, not every possible label. The counts know them without a pass over the volume.
+        present = set(int(label) for label in label_counts.present() if int(label) in meshes.keys())
 
-                self.surfaceMappers[label].SetInputData(self.marchingCubes[self.t][label])
-
-                if self.visible[label]:
-                    self.surfaceActors[label].VisibilityOn()
-                    self.surfaceActors[label].SetPickable(1)
-                    self.surfaceActors[label].Modified()
-            else:
-                self.surfaceActors[label].VisibilityOff()
+        if self.render_mode == "lut":
+            self.combined_visible = None  # built again by update_label_actors
+        else:
+            # The actors of labels which left are reused first
+            for label in self.shown_labels - present:
+                self.release_surface_actor(label)
+
+            for label in present:
+                self.get_surface_actor(label)
+                self.surfaceMappers[label].SetInputData(meshes[label])
+                self.surfaceActors[label].Modified()
+
+        self.shown_labels = present
+        self.lod_level = 0
+        self.update_label_actors()
+
+        # The selected voxels have their own actor
+        if label_counts.selected > 0 and selection in meshes.keys():
+            self.selectionMapper.SetInputData(meshes[selection])
+            self.selectionActor.VisibilityOn()
+        else:
+            self.selectionActor.VisibilityOff()
 
         # Add the raw data if exists
         if len(self.raw) > self.t:
@@ -1113,8 +1939,7 @@ class Visualizer_3D:
         # Determine which object was clicked based on point coordinates
         
         if len(self.selected_labels) == 0:
-            self.backup = vtk.vtkImageData()
-            self.backup.DeepCopy(self.imageDataObjects[self.t])
+            self.backup = self.get_numpy_array(self.t).copy(order = 'F')
 
         array = self.oversegmentations[self.t]
 
@@ -1127,26 +1952,8 @@ class Visualizer_3D:
             found = array[z, y, x]
             closest_point_position = [z, y, x]
         else:
-            # Construct a list of positions and values for all non-zero points excluding the ones marked modified
-            non_zero_positions = np.argwhere(array != 0)
-            valid_indices = [i for i, pos in enumerate(non_zero_positions) if array[tuple(pos)] not in self.modified]
-            valid_positions = non_zero_positions[valid_indices]
-            
-            # Proceed only if there are valid positions to search within
-            if len(valid_positions) > 0:
-                # Build a KDTree from non-zero positions
-                tree = cKDTree(valid_positions)
-                
-                # Query the single closest point to the clicked position
-                distance, index = tree.query([z, y, x])
-                
-                closest_point_position = valid_positions[index]
-                found = array[tuple(closest_point_position)]
-                #print(f"Closest non-zero pixel found at (Z, Y, X): {closest_point_position[0]}, {closest_point_position[1]}, {closest_point_position[2]}")
-                #print(f"Pixel value: {found}")
-            else:
-                #print("No non-zero pixel found within search radius.")
-                closest_point_position = None
+            # The closest chunk voxel, excluding the chunks marked modified
+            closest_point_position, found = self.get_chunk_index(self.t).nearest([z, y, x], self.modified.keys())
 
         if self.magic_wand:
             return closest_point_position
@@ -1155,32 +1962,28 @@ class Visualizer_3D:
             return
         
         # Identify and modify the selected object in the visualization as needed
-        selected = np.transpose(np.where(array == found))
+        selection = self.selection_label()
+
+        # Only the visible labels are selected, and voxels which were selected before are left alone
+        def selectable(values):
+            keep = (values > 0) & (values != selection)
+            keep[keep] = self.are_labels_visible(values[keep])
+            return keep
 
-        vtk_array = self.imageDataObjects[self.t].GetPointData().GetScalars()
+        written, old_values = self.write_labels(self.t, self.voxels_of_chunk(self.t, found), selection, selectable)
 
         # Only update if the chunk is currently visible
-        clicked_on_visible_chunk = False
-        
-        for p in selected:
-            i, j, k = p
-            id = self.imageDataObjects[self.t].ComputePointId((i, j, k))
-            real_id = vtk_array.GetTuple1(id)
-            # Only update if the object was not previously modified
-            if real_id > 0 and real_id != 255 and self.visible[real_id]:
-                self.modified[found] = real_id
-                vtk_array.SetTuple1(id, 255)
-                clicked_on_visible_chunk = True
-
-                if real_id not in self.selected_labels:
-                    self.selected_labels.append(real_id)
-
-        if not clicked_on_visible_chunk:
+        if len(written) == 0:
             return
-        
-        self.create_highlight_actors(found)
 
-        self.imageDataObjects[self.t].Modified()
+        self.modified[found] = float(old_values[-1])
+
+        _, first = np.unique(old_values, return_index = True)
+        for real_id in old_values[np.sort(first)]:
+            if float(real_id) not in self.selected_labels:
+                self.selected_labels.append(float(real_id))
+
+        self.create_highlight_actors(found)
 
         self.selectedLabelsActor.SetInput("selected: " + ", ".join([str(int(x)) for x in self.selected_labels]))
 
@@ -1242,12 +2045,19 @@ class Visualizer_3D:
         """
         Saves the current state of all image data objects to TIF files, allowing users to select a save directory.
         Now it extracts the original filenames and saves them in the new folder.
+        Saving again to the same folder only writes the frames changed since. Frames which were never edited are
+        copied from their source files, the others are written by a pool of threads.
         """
 
         self.log("visualizer.py: save_image_data_objects")
 
         self.show_all_labels()
         self.clear_selection()
+        self.prefetcher.cancel()
+
+        if self.store is not None:
+            self.save_to_store()
+            return
         
         # Initiate a Tkinter root window but keep it hidden
         root = tk.Tk()
@@ -1261,25 +2071,73 @@ class Visualizer_3D:
             print("No folder selected.")
             return
 
-        # Iterate through imageDataObjects and save each as a TIF file
-        for idx, imageData in enumerate(self.imageDataObjects):
-            # Extract numpy array from vtkImageData
-            array = vtk_to_numpy(imageData.GetPointData().GetScalars())
-            time.sleep(0.3)
-            dims = imageData.GetDimensions()
-            array = array.reshape(dims, order='F')  # Reshape according to the dimensions of the vtkImageData
+        if folder_selected == self.save_folder:
+            to_save = sorted(self.frames.unsaved)
+        else:
+            to_save = list(range(len(self.frames)))
+
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            jobs = []
+
+            for idx in to_save:
+                # Extract the original filename from the full path
+                original_filename = os.path.basename(self.filenames[idx])
+                # Create the new file path
+                file_path = os.path.join(folder_selected, original_filename)
+
+                if self.frames.is_modified(idx):
+                    # A loaded frame may still have this file memory-mapped
+                    self.frames.release_file(file_path)
+
+                    # The labels are already integers, so they are written as they are
+                    jobs.append(executor.submit(write_tiff, file_path, self.get_numpy_array(idx), self.compression))
+                else:
+                    jobs.append(executor.submit(copy_tiff, self.filenames[idx], file_path))
+
+            for job in jobs:
+                print(f"Saved: {job.result()}")
+
+        self.frames.mark_saved(to_save)
+        self.save_folder = folder_selected
+        self.save_relabelled(folder_selected)
+        self.update_mesh_cache(to_save)
+
+        print(f"{len(to_save)} images have been saved in {time.time() - start_time:.2f} s.")
 
-            # Extract the original filename from the full path
-            original_filename = os.path.basename(self.filenames[idx])
-            # Create the new file path
-            file_path = os.path.join(folder_selected, original_filename)
+    ####################################################################################################
+
+    def save_to_store(self):
+        """
+        Writes the labels of the frames edited since the last save back into the chunk store, only the chunks around
+        the voxels written since (see grow_extent). Frames where that isn't known are compared with the store.
+        """
+
+        self.log("visualizer.py: save_to_store")
+
+        to_save = sorted(self.frames.unsaved)
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            jobs = []
+            for idx in to_save:
+                frame = self.frames.get(idx)
 
-            # Save the numpy array as a TIF file
-            imwrite(file_path, array)
+                # A box over the whole frame, e.g. for edits from before it was spilled, is compared chunk by chunk instead
+                box = frame.save_box
+                if box is not None and all(part.start == 0 and part.stop == size for part, size in zip(box, frame.labels.shape)):
+                    box = None
 
-            print(f"Saved: {file_path}")
+                jobs.append(executor.submit(self.store.write, "labels", self.store_time_points[idx], frame.labels, box))
 
-        print("All images have been saved.")
+            chunks = sum(job.result() for job in jobs)
+
+        self.frames.mark_saved(to_save)
+        self.save_relabelled(self.store.path)
+        self.update_mesh_cache(to_save)
+
+        print(f"{chunks} chunks of {len(to_save)} images have been saved in {time.time() - start_time:.2f} s.")
 
 ##################################################################################################################
 
@@ -1302,16 +2160,12 @@ class Visualizer_3D:
         sources = self.selected_voxels
 
         self.clear_selection()
+        self.fit_label(self.t, destination)
         
-        vtk_array = self.imageDataObjects[self.t].GetPointData().GetScalars()
+        _, old_values = self.write_labels(self.t, sources, destination)
 
-        modified_labels = [destination]
-        for p in sources:
-            real_id = vtk_array.GetTuple1(p)
-            modified_labels.append(real_id)
-            vtk_array.SetTuple1(p, destination)
-
-        modified_labels = np.unique(modified_labels)
+        self.frames.mark_dirty(self.t)
+        modified_labels = np.unique(np.concatenate([[destination], old_values]))
         self.undo_labels = modified_labels
             
         self.init_surfaces(modified_labels, self.t)
@@ -1365,18 +2219,26 @@ class Visualizer_3D:
 
     ##########################################################################################################################
     def find_available_label(self):
-        # Find the maximum label
-        available_labels = list(range(1, 255))
+        """ Reserves the smallest label not used in any frame, or returns 0 if max_label is reached. """
 
-        for t in self.labels_per_image.keys():
-            for label in self.labels_per_image[t]:
-                if label in available_labels:
-                    available_labels.remove(label)
+        return self.label_pool.take()
 
-        if len (available_labels) > 0:
-            return available_labels[0]
-        else:
-            return 0
+    ##########################################################################################################################
+
+    def save_relabelled(self, folder):
+        """ Writes which labels were replaced at loading (see max_label) to relabelled.csv in folder, if any were. """
+
+        if len(self.relabelled) == 0:
+            return
+
+        with open(os.path.join(folder, "relabelled.csv"), "w", newline = "") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time point", "source", "old label", "new label"])
+
+            for t in sorted(self.relabelled.keys()):
+                name = os.path.basename(self.filenames[t]) if self.store is None else self.store_time_points[t]
+                for old_label, new_label in sorted(self.relabelled[t].items()):
+                    writer.writerow([t, name, old_label, new_label])
 
     ##########################################################################################################################
     def make_new(self):
@@ -1412,21 +2274,14 @@ class Visualizer_3D:
     ##########################################################################################################################
 
     def get_numpy_array(self, t):
-        """ Covert the VTK array for time point t back to numpy representation """
+        """
+        The labels of time point t as a (z, y, x) numpy array. It is not a copy: writes into it change the vtkImageData
+        too, which then only needs Modified(), and the frame has to be marked dirty.
+        """
 
         self.log("visualizer.py: get_numpy_array")
 
-        image_data_object = self.imageDataObjects[t]
-        # Extract the VTK array and convert it back to a NumPy array
-        vtk_scalars = image_data_object.GetPointData().GetScalars()
-        scalars_array = vtk_to_numpy(vtk_scalars)
-        
-        # Transform the array back into the shape it had before being raveled and ensure correct array order
-        dims = image_data_object.GetDimensions()
-        reshaped_array = scalars_array.reshape(dims[2], dims[1], dims[0]).transpose(2, 1, 0)
-        reshaped_array = np.ascontiguousarray(reshaped_array)  # Ensure contiguous array for manipulation
-
-        return reshaped_array
+        return self.frames.get(t).labels
 
     ##########################################################################################################################        
         
@@ -1436,25 +2291,44 @@ class Visualizer_3D:
         self.log("visualizer.py: recolor")
 
         self.clear_selection()
+        self.prefetcher.cancel()
 
         # Perform the merging operation
+        submitted = []
 
-        for t in range(len(self.imageDataObjects)):
+        for t in self.frames.iterate(range(len(self.frames))):
 
-            reshaped_array = self.get_numpy_array(t)
-            
-            # Find indices where color needs to be changed (considering the reshaped array structure)
-            for source in sources:
-                reshaped_array[reshaped_array == source] = destination
+            # Frames without the source labels stay as they are, and aren't saved again
+            mask = np.isin(self.get_numpy_array(t), sources)
+            if not mask.any():
+                continue
 
-            # Convert the reshaped array back to Fortran order and ravel it for VTK
-            scalars_fortran_order = np.asfortranarray(reshaped_array.transpose(2, 1, 0))
-            new_vtk_scalars = numpy_to_vtk(num_array=scalars_fortran_order.ravel(), deep = True, array_type=vtk.VTK_FLOAT)
-            
-            # Update the vtkImageData object
-            self.imageDataObjects[t].GetPointData().SetScalars(new_vtk_scalars)
+            self.fit_label(t, destination)
+            labels = self.get_numpy_array(t)
+
+            # Written in place, the vtkImageData shares the buffer
+            labels[mask] = destination
 
-            self.init_surfaces(sources + [destination], t)
+            frame = self.frames.get(t)
+            frame.label_counts.merge(sources, destination)
+            if frame.label_voxels is not None:
+                frame.label_voxels.moved(np.flatnonzero(mask.reshape(-1, order = 'F')), destination)
+
+            extents = self.frames.get(t).extents
+            if extents is not None:
+                for source in sources:
+                    self.grow_extent(t, destination, extents.get(int(source)))
+            else:
+                frame.save_box = union_box(frame.save_box, box_of_mask(mask))
+
+            self.imageDataObjects[t].Modified()
+            self.frames.mark_dirty(t)
+
+            submitted.append(self.submit_surfaces(sources + [destination], t))
+
+        # The frames are meshed in parallel, the results are stored in the order of the frames
+        for job in submitted:
+            self.gather_surfaces(job)
             
         self.set_current_image(self.t)
         self.renderer.GetRenderWindow().Render()
@@ -1474,8 +2348,10 @@ class Visualizer_3D:
         
         if not self.modified:
             return
-        
-        vtk_array = self.imageDataObjects[self.t].GetPointData().GetScalars()
+
+        # A new destination label may not fit into the integer type of the frame
+        if self.destination_color > 0:
+            self.fit_label(self.t, self.destination_color)
 
         if self.destination_color > 0:
             destination = self.destination_color
@@ -1484,28 +2360,13 @@ class Visualizer_3D:
         else:
             # Clear the destination chunk
             overseg_index, destination = self.modified.popitem()
-            selected = np.transpose(np.where(self.oversegmentations[self.t] == overseg_index))
-            modified_labels = [destination]
-         
-            for p in selected:
-                i, j, k = p
-                id = self.imageDataObjects[self.t].ComputePointId((i, j, k))
-                real_id = vtk_array.GetTuple1(id)
-                modified_labels.append(real_id)
-                vtk_array.SetTuple1(id, destination)
-
-            modified_labels = np.unique(modified_labels)
+            self.write_labels(self.t, self.voxels_of_chunk(self.t, overseg_index), destination)
 
         # Recolor the source chunks
-        for overseg_index in self.modified.keys():
-            selected = np.transpose(np.where(self.oversegmentations[self.t] == overseg_index))
-
-            for p in selected:
-                i, j, k = p
-                id = self.imageDataObjects[self.t].ComputePointId((i, j, k))
-                vtk_array.SetTuple1(id, destination)
+        if len(self.modified) > 0:
+            self.write_labels(self.t, np.concatenate([self.voxels_of_chunk(self.t, chunk) for chunk in self.modified.keys()]), destination)
 
-        self.imageDataObjects[self.t].Modified()
+        self.frames.mark_dirty(self.t)
         #self.volumeMapper.Modified()
 
         print ("Selected labels = ", self.selected_labels)
@@ -1531,13 +2392,12 @@ class Visualizer_3D:
         self.log("visualizer.py: clear_selection")
 
         if self.backup is not None:
-            self.imageDataObjects[self.t].DeepCopy(self.backup)
-            self.imageDataObjects[self.t].Modified()
+            self.restore_label_array(self.t, self.backup)
             #self.volumeMapper.Modified()
             self.backup = None
 
         if self.magic_wand:
-            self.init_surfaces(self.selected_labels + [255], self.t)
+            self.init_surfaces(self.selected_labels + [self.selection_label()], self.t)
         else:
             self.remove_highlight_actors()
 
@@ -1651,10 +2511,10 @@ class Visualizer_3D:
         marked = self.get_labels_from_file()
 
         for label in marked:
-            if label in self.surfaceActors.keys() and label != 255:
-                self.surfaceActors[label].SetVisibility(0)
-                self.surfaceActors[label].SetPickable(0)
-                self.visible[label] = False
+            self.ensure_label_capacity(label)
+            self.visible[int(label)] = False
+
+        self.update_label_actors()
 
         self.renderer.GetRenderWindow().Render()
 
@@ -1674,11 +2534,12 @@ class Visualizer_3D:
 
         marked = self.get_labels_from_file()
 
-        for label in self.surfaceActors.keys():
-            if label not in marked and label != 255:
-                self.surfaceActors[label].SetVisibility(0)
-                self.surfaceActors[label].SetPickable(0)
-                self.visible[label] = False
+        self.visible[:] = False
+        for label in marked:
+            self.ensure_label_capacity(label)
+            self.visible[int(label)] = True
+
+        self.update_label_actors()
 
         self.renderer.GetRenderWindow().Render()
 
@@ -1691,12 +2552,7 @@ class Visualizer_3D:
         self.log("visualizer.py: show_all_labels")
         
         # Show all labels that were previously hidden
-        for label in self.surfaceActors.keys():
-            self.surfaceActors[label].SetVisibility(1)
-            self.surfaceActors[label].SetPickable(1)
-
-        for label in range(1, 256):
-            self.visible[label] = True
+        self.visible[:] = True
 
         self.set_current_image(self.t)
 
@@ -1764,7 +2620,7 @@ class Visualizer_3D:
         for obj in selected:
 
             # find the set of points within this label
-            z, y, x = np.where(img == obj);
+            z, y, x = np.unravel_index(self.voxels_of_chunk(self.t, obj), img.shape, order = 'F')
             all_points = np.vstack([z, y, x]).T
             size = len(all_points)
 
@@ -1817,52 +2673,9 @@ class Visualizer_3D:
     ###################################################################################################################
 
     def split_overseg_labels_spanning_several_real(self, img, overseg, label = None):
-        
 
         self.log("visualizer.py: split_overseg_labels_spanning_several_real")
-        unique_labels = np.unique(overseg)
-        # Ensure we don't process the background (0 label)
-        mask = overseg != 0
-        max_label = unique_labels[-1]
-        
-        img_flattened = img[mask]
-        overseg_flattened = overseg[mask]
-        new_overseg = overseg.copy()
-
-        to_split = unique_labels[1:]
-        if label is not None:
-            to_split = [label]
-
-        for obj in to_split:
-            mask_obj = overseg_flattened == obj
-            img_segment = img_flattened[mask_obj]
-            
-            # Skipping background pixels if present
-            img_segment = img_segment[img_segment > 0]
-            
-            if len(img_segment) > 0:
-                unique_components = list(np.unique(img_segment))
-                if 0 in unique_components:
-                    unique_components.remove(0)
-                
-                if len(unique_components) == 1:
-                    # Segment is homogeneous enough; skip splitting
-                    continue
-                else:
-                    # If not homogeneous, proceed with individual adjustments
-                    mode_label = unique_components[0]
-                    max_label += 1
-                    specific_mask = (overseg == obj) & (img == mode_label)
-                    #new_overseg[specific_mask] = max_label + 1
-                    # Ensure other objects in the segment get unique labels if they do not exceed the threshold
-                    for real_obj in np.unique(img_segment):
-
-                        if real_obj != mode_label:
-                            max_label += 1
-                            specific_mask = (overseg == obj) & (img == real_obj)
-                            new_overseg[specific_mask] = max_label
-
-        return new_overseg
+        return split_overseg_labels_spanning_several_real(img, overseg, label)
 
 ################################################################################
 
@@ -1887,8 +2700,6 @@ class Visualizer_3D:
         elif direction == "plus_y":
             dx = 0
 
-        actor = self.surfaceActors[self.destination_color]
-
         # Obtain the orientation vectors of the camera
         camera = self.renderer.GetActiveCamera()
         camPosition = camera.GetPosition()
@@ -1915,20 +2726,17 @@ class Visualizer_3D:
         worldDisplacement = [rightDirection[i] * dx + adjustedUpDirection[i] * dy for i in range(3)]
         
         # Apply the displacement, preserving the original Z position
-        actorPosition = actor.GetPosition()
+        label = int(self.destination_color)
+        actorPosition = self.label_positions.get(label, (0, 0, 0))
         newActorPosition = [actorPosition[i] + worldDisplacement[i] for i in range(3)]
-            
-        # Create a transform that represents the translation
-        transform = vtk.vtkTransform()
-        
-        # Get the current position of the actor
-        current_position = actor.GetPosition()
-        
-        # Apply the translation to the current position to get the new position
-        new_position = [current_position[0] + dx, current_position[1] + dy, current_position[2] + dz]
-        
-        # Set the actor's position to the new position
-        actor.SetPosition(newActorPosition)
+        self.label_positions[label] = tuple(newActorPosition)
+
+        # The 'lut' render mode moves the label inside the combined mesh. A label which isn't shown only keeps its
+        # position for when it is.
+        if self.render_mode == "lut":
+            self.show_combined_labels(self.combined_visible or (), self.lod_level)
+        elif label in self.surfaceActors:
+            self.surfaceActors[label].SetPosition(newActorPosition)
         
     ####################################################################################################
 
@@ -1943,7 +2751,6 @@ class Visualizer_3D:
         self.clear_selection()
         
     
-        actor = self.surfaceActors[selected]
 
         # Function to handle the input ID and highlight object
         def handle_input(event = None):
@@ -1952,8 +2759,7 @@ class Visualizer_3D:
             hex_color = user_input.lstrip('#')  # Remove the '#' symbol if it's there
             lv = len(hex_color)
             rgb_color = tuple(int(hex_color[i:i + lv // 3], 16) / 255.0 for i in range(0, lv, lv // 3))
-            self.colorTransferFunction.AddRGBPoint(selected, rgb_color[0], rgb_color[1], rgb_color[2])
-            actor.GetProperty().SetColor(rgb_color)  # Set the actor's color
+            self.set_label_color(selected, rgb_color)  # Also sets the actor's color
             self.renderer.GetRenderWindow().Render()
         
             input_window.destroy()  # Close the window after input is handled
@@ -2045,10 +2851,7 @@ class Visualizer_3D:
             self.t = t
           
             self.set_current_image(self.t)
-            imageData = self.imageDataObjects[t]
-            array = vtk_to_numpy(imageData.GetPointData().GetScalars())
-            dims = imageData.GetDimensions()
-            array = array.reshape(dims, order='F')
+            array = self.get_numpy_array(t)
             
             self.center_on_point(self.center_of_mass(array))
             
@@ -0,0 +1,133 @@
+"""
+    The voxels of every label of a frame, to find the voxels of one object without a pass over the volume.
+    The flat voxel indices are sorted by label once (compressed sparse rows: one sorted array and where each
+    label starts in it), and the voxels written since are kept apart until there are many of them.
+    The background is most of the volume and is never looked up, so it is left out.
+"""
+import numpy as np
+
+class VoxelIndex:
+
+    def __init__(self, array):
+        """
+        :param array: A (z, y, x) array of labels, e.g. the segmentation or the oversegmentation of a frame.
+            Voxels are given by their flat index in Fortran order, which is the VTK point id.
+        """
+        self.array = array
+        self.order = None   # flat indices sorted by label, built the first time it is needed
+        self.values = None  # the labels in the array when it was built, increasing
+        self.starts = None  # order[starts[i]:starts[i + 1]] are the voxels of values[i]
+        self.added = {}     # label -> arrays of flat indices written with it since
+        self.added_size = 0
+
+    ##############################################################################################################################
+
+    def flat(self, array):
+        """ The array as one dimensional, in Fortran order if it is stored so, else in C order, so that it is usually not copied. """
+        return array.reshape(-1, order = 'F' if self.array.flags.f_contiguous else 'C')
+
+    def fortran_ids(self, ids):
+        """ Flat indices into flat() as flat indices in Fortran order. """
+        if self.array.flags.f_contiguous:
+            return ids
+
+        return np.ravel_multi_index(np.unravel_index(ids, self.array.shape), self.array.shape, order = 'F')
+
+    ##############################################################################################################################
+
+    def build(self):
+        flat = self.flat(self.array)
+        foreground = np.flatnonzero(flat)
+        values = flat[foreground]
+        ids = self.fortran_ids(foreground)
+
+        # By label, and the voxels of each label in increasing order
+        order = np.lexsort((ids, values))
+        ids = ids[order]
+        self.order = ids.astype(np.int32) if flat.size < 2**31 else ids
+
+        self.values, starts = np.unique(values[order], return_index = True)
+        self.starts = np.append(starts, len(ids))
+
+        self.added = {}
+        self.added_size = 0
+
+    ##############################################################################################################################
+
+    def voxels(self, label):
+        """ The flat indices of the voxels holding label, in increasing order. """
+        if label == 0:
+            return np.sort(self.fortran_ids(np.flatnonzero(self.flat(self.array) == 0)))
+
+        if self.order is None:
+            self.build()
+
+        i = np.searchsorted(self.values, label)
+        if i < len(self.values) and self.values[i] == label:
+            ids = self.order[self.starts[i]:self.starts[i + 1]].astype(np.int64)
+        else:
+            ids = np.zeros(0, np.int64)
+
+        added = self.added.get(int(label))
+        if added:
+            ids = np.union1d(ids, np.concatenate(added))
+
+        # Voxels which were written with another label since are still listed, they are left out here
+        if self.added_size > 0:
+            ids = ids[self.array[np.unravel_index(ids, self.array.shape, order = 'F')] == label]
+
+        return ids
+
+    ##############################################################################################################################
+
+    def moved(self, ids, labels):
+        """ Called after the voxels with the flat indices ids were set to labels (one label, or one per voxel). """
+        if self.order is None:
+            return
+
+        ids = np.asarray(ids, dtype = np.int64).ravel()
+        if len(ids) == 0:
+            return
+
+        if np.ndim(labels) == 0:
+            self.added.setdefault(int(labels), []).append(ids)
+        else:
+            labels = np.asarray(labels).ravel()
+            order = np.argsort(labels, kind = 'stable')
+            values, starts = np.unique(labels[order], return_index = True)
+            for value, part in zip(values, np.split(ids[order], starts[1:])):
+                self.added.setdefault(int(value), []).append(part)
+
+        self.added_size += len(ids)
+
+        # Sorted again once the written voxels pile up, a pass over the volume for every size / 16 written voxels
+        if self.added_size > self.array.size // 16:
+            self.order = None
+
+    ##############################################################################################################################
+
+    def update(self, array):
+        """ Called when the array is replaced by a new one, e.g. the oversegmentation after chunks were split. """
+        if array is self.array:
+            return
+
+        previous, self.array = self.array, array
+
+        if self.order is None:
+            return
+
+        if array.shape != previous.shape:
+            self.order = None
+            return
+
+        changed = np.flatnonzero(self.flat(array != previous))
+        self.moved(self.fortran_ids(changed), self.flat(array)[changed])
+
+    ##############################################################################################################################
+
+    def nbytes(self):
+        if self.order is None:
+            return 0
+
+        added = sum(ids.nbytes for parts in self.added.values() for ids in parts)
+        return self.order.nbytes + self.values.nbytes + self.starts.nbytes + added